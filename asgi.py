@@ -0,0 +1,3 @@
+import journal
+
+application = journal.create_asgi_app_from_config_file()
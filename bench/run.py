@@ -0,0 +1,453 @@
+"""Benchmarks the journal against a seeded database and writes the numbers out as JSON.
+
+    python bench/run.py                                   # in-process fake database (needs mongomock)
+    python bench/run.py --mongo mongodb://localhost --gunicorn
+    python bench/run.py --sqlite /tmp/bench.sqlite3 --gunicorn
+    python bench/run.py --trace bench/trace.example.jsonl --baseline baseline.json
+
+Every scenario reports p50/p99 latency, throughput and database queries per request. With --mongo or --sqlite
+the given database is dropped and re-seeded first, so never point it at one you care about.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+import pymongo
+import pytz
+from pymongo import monitoring
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import journal  # noqa: E402
+from journal.db import Entry, User, migrations  # noqa: E402
+
+PASSWORD = 'benchmark password'
+TAGS = ['work', 'family', 'travel', 'health', 'ideas', 'books', 'music', 'food', 'dreams', 'gratitude']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+         'dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip').split()
+# commands that aren't queries the app made
+IGNORED_COMMANDS = {'hello', 'ismaster', 'isMaster', 'ping', 'endSessions', 'buildInfo', 'serverStatus'}
+
+
+class QueryCounter(monitoring.CommandListener):
+    """Counts MongoDB commands sent by this process."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name not in IGNORED_COMMANDS:
+            with self._lock:
+                self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def use_mongomock(counter: QueryCounter):
+    """Points pymongo at one shared in-memory mongomock database, counting collection calls as queries."""
+    import mongomock
+
+    class Client(mongomock.MongoClient):
+        def get_database(self, name=None, codec_options=None, **kwargs):
+            return super().get_database(name)  # mongomock can't do tz-aware codec options
+
+        def close(self):
+            pass  # the data would be gone, there's no server keeping it
+
+    shared = Client()
+    pymongo.MongoClient = lambda *args, **kwargs: shared
+
+    count_calls(mongomock.collection.Collection, counter)
+
+
+# the collection methods that make queries, wrapped to count them where no command listener can
+QUERY_METHODS = ['aggregate', 'bulk_write', 'count_documents', 'delete_many', 'delete_one', 'find', 'find_one',
+                 'find_one_and_update', 'insert_many', 'insert_one', 'replace_one', 'update_many', 'update_one']
+
+
+def count_calls(cls, counter: QueryCounter):
+    depth = threading.local()  # implementations call their own public methods, only the outermost one counts
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            outermost = not getattr(depth, 'value', 0)
+            if outermost:
+                with counter._lock:
+                    counter.count += 1
+            depth.value = getattr(depth, 'value', 0) + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                depth.value -= 1
+        return wrapper
+
+    for name in QUERY_METHODS:
+        if hasattr(cls, name):
+            setattr(cls, name, counted(getattr(cls, name)))
+
+
+def make_settings(args, counter: QueryCounter = None) -> dict:
+    settings = {
+        'mongodb_uri': args.mongo or 'mongodb://localhost', 'mongodb_db': args.db,
+        'idgen_worker_id': 'auto' if args.mongo else 0, 'secret_key': 'benchmark secret',
+        'recaptcha_enabled': False, 'ratelimit_enabled': False, 'auto_migrate': True,
+    }
+    if args.sqlite:
+        settings.update(storage_backend='sqlite', sqlite_path=os.path.abspath(args.sqlite), idgen_worker_id='auto')
+    if counter is not None and args.mongo:
+        settings['mongodb_options'] = {'event_listeners': [counter]}
+    return settings
+
+
+def seed(app, args, rng: random.Random) -> list:
+    """Creates the users and their entries, returns what the scenarios need to know about each user."""
+    db = app.db
+    db.drop()
+    db.ensure_indexes()
+
+    # hashing once is plenty, every user gets the same password
+    first = db.create_user('bench0', PASSWORD)
+    template = first.serialize()
+    users = [template] + [dict(template, _id=_id, username='bench{}'.format(i))
+                          for i, _id in enumerate(db.id_gen.generate_many(args.users - 1), 1)]
+    if len(users) > 1:
+        db.users.insert_many(users[1:])
+
+    now = datetime.datetime.now(tz=pytz.UTC)
+    seeded = []
+    for raw in users:
+        user = User(db, **raw)
+        docs = []
+        for _ in range(args.entries):
+            # IDs dated like the entries, listings sort by ID like they would for real ones
+            timestamp = now - datetime.timedelta(milliseconds=rng.randrange(1000 * 60 * 60 * 24 * 365))
+            entry = Entry(db, _id=db.id_gen.generate_at(timestamp), author_id=user.id, timezone='UTC',
+                          timestamp=timestamp)
+            entry.title = ' '.join(rng.choices(WORDS, k=rng.randint(2, 6))).capitalize()
+            entry.content = '\n\n'.join(' '.join(rng.choices(WORDS, k=rng.randint(20, 80)))
+                                        for _ in range(rng.randint(1, args.paragraphs)))
+            entry.tags = rng.sample(TAGS, rng.randint(0, 3))
+            docs.append(entry.serialize())
+        for start in range(0, len(docs), 1000):
+            db.entries.insert_many(docs[start:start + 1000])
+
+        csrf = db.jwt.encode(exp=now + datetime.timedelta(days=1), aud=str(user.id))
+        seeded.append({'username': user.username, 'id': user.id, 'token': user.create_token(), 'csrf': csrf,
+                       'entries': [x['_id'] for x in docs]})
+    db.rebuild_tags()
+
+    # a benchmark of collection scans is no benchmark, mongomock can't explain anything though
+    if args.mongo or args.sqlite:
+        problems = migrations.check_listing_indexes(db, seeded[0]['id'], TAGS[0])
+        if problems:
+            raise SystemExit('Index regression: ' + '; '.join(problems))
+    return seeded
+
+
+# scenarios turn a seeded user into one request: (method, path, options)
+
+def login(user, rng):
+    return 'POST', '/api/login', {'json': {'username': user['username'], 'password': PASSWORD}}
+
+
+def listing(user, rng):
+    return 'GET', '/app/entries', {'cookie': True}
+
+
+def view(user, rng):
+    return 'GET', '/app/entry/{}/view'.format(rng.choice(user['entries'])), {'cookie': True}
+
+
+def edit(user, rng):
+    form = {'title': 'Edited', 'body': ' '.join(rng.choices(WORDS, k=50)), 'tags': 'work, ideas',
+            'csrf': user['csrf']}
+    return 'POST', '/app/entry/{}/edit'.format(rng.choice(user['entries'])), {'cookie': True, 'data': form}
+
+
+def api_list(user, rng):
+    return 'GET', '/api/entries', {'auth': True}
+
+
+def export(user, rng):
+    return 'GET', '/api/export', {'auth': True}
+
+
+SCENARIOS = {'login': login, 'listing': listing, 'view': view, 'edit': edit, 'api_list': api_list,
+             'export': export}
+
+
+def trace_scenario(path):
+    """Replays a recorded trace, one JSON request per line. See bench/trace.example.jsonl."""
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    position = iter(range(sys.maxsize))
+
+    def replay(user, rng):
+        line = lines[next(position) % len(lines)]
+        entry_id = rng.choice(user['entries'])
+        options = {'auth': line.get('auth', False), 'cookie': line.get('cookie', False)}
+        for key in ['json', 'data']:
+            if key in line:
+                options[key] = json.loads(json.dumps(line[key]).replace('{entry_id}', str(entry_id)))
+        if 'data' in options and options['cookie']:
+            options['data'].setdefault('csrf', user['csrf'])
+        return line.get('method', 'GET'), line['path'].replace('{entry_id}', str(entry_id)), options
+
+    return replay
+
+
+def headers_for(user, options) -> dict:
+    headers = {}
+    if options.get('auth'):
+        headers['Authorization'] = user['token']
+    if options.get('cookie'):
+        headers['Cookie'] = 'token=' + user['token']
+    return headers
+
+
+class FlaskDriver:
+    """Calls the app in-process through Flask's test client, one client per thread."""
+
+    name = 'flask'
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def __call__(self, user, method, path, options) -> typing.Tuple[int, typing.Optional[str]]:
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client(use_cookies=False)  # or it'd replace our Cookie header
+        resp = self._local.client.open(path, method=method, headers=headers_for(user, options),
+                                       json=options.get('json'), data=options.get('data'))
+        resp.get_data()  # streamed responses only do their work while being read
+        return resp.status_code, resp.headers.get('Location')
+
+
+class HTTPDriver:
+    """Talks HTTP to a running server, one keep-alive session per thread."""
+
+    name = 'gunicorn'
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._local = threading.local()
+
+    def __call__(self, user, method, path, options) -> typing.Tuple[int, typing.Optional[str]]:
+        import requests
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        resp = self._local.session.request(method, self.base_url + path, headers=headers_for(user, options),
+                                           json=options.get('json'), data=options.get('data'),
+                                           allow_redirects=False)
+        return resp.status_code, resp.headers.get('Location')
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run_scenario(driver, scenario, users, args, queries) -> dict:
+    rng = random.Random(args.seed)
+    plan = [(user,) + scenario(user, rng) for user in (rng.choice(users) for _ in range(args.requests))]
+    for user, method, path, options in plan[:args.warmup]:
+        driver(user, method, path, options)
+
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def one(item):
+        nonlocal errors
+        user, method, path, options = item
+        start = time.perf_counter()
+        status, location = driver(user, method, path, options)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400 or (location or '').endswith('/logout'):  # the latter means we weren't logged in
+                errors += 1
+
+    before = queries()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(one, plan))
+    wall = time.perf_counter() - start
+    after = queries()
+    made = after - before if after is not None else None
+
+    latencies.sort()
+    return {
+        'requests': len(plan),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'throughput_rps': round(len(plan) / wall, 1),
+        'queries_per_request': round(made / len(plan), 2) if made is not None else None,
+    }
+
+
+def run_all(driver, scenarios, users, args, queries) -> dict:
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name] = run_scenario(driver, scenario, users, args, queries)
+        print('{:>9} {:>10} {:>8} p50 {:>8} p99 {:>8} rps {:>6} q/req {:>5} err'.format(
+            driver.name, name, results[name]['p50_ms'], results[name]['p99_ms'],
+            results[name]['throughput_rps'], str(results[name]['queries_per_request']), results[name]['errors']),
+            file=sys.stderr)
+    return results
+
+
+def server_queries(client):
+    """Operations the server has seen, from any process, for when the app runs elsewhere."""
+    def count():
+        ops = client.admin.command('serverStatus')['opcounters']
+        return sum(ops[k] for k in ['query', 'insert', 'update', 'delete', 'getmore'])
+    return count
+
+
+def run_gunicorn(args, scenarios, users) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        settings = make_settings(args)
+        settings['auto_migrate'] = False
+        settings['mongodb_options'] = {'maxPoolSize': args.threads}
+        with open(os.path.join(tmp, 'config.yml'), 'w') as f:
+            json.dump(settings, f)  # JSON is YAML too
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--threads', str(args.threads),
+            '--bind', '127.0.0.1:{}'.format(port), '--chdir', tmp, '--pythonpath', REPO, 'wsgi',
+        ])
+        try:
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            _wait_for(base_url, server)
+            if args.sqlite:  # the queries happen in the workers, where we can't count them
+                return run_all(HTTPDriver(base_url), scenarios, users, args, lambda: None)
+            client = pymongo.MongoClient(args.mongo)
+            return run_all(HTTPDriver(base_url), scenarios, users, args, server_queries(client))
+        finally:
+            server.terminate()
+            server.wait(30)
+
+
+def _wait_for(base_url, server, timeout=30):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit('gunicorn exited with {}'.format(server.returncode))
+        try:
+            requests.get(base_url + '/login', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise SystemExit('gunicorn did not come up within {} seconds'.format(timeout))
+
+
+def compare(results, baseline):
+    """Prints how far each number moved relative to an earlier run."""
+    for mode, scenarios in results.items():
+        for name, now in scenarios.items():
+            then = baseline.get('results', {}).get(mode, {}).get(name)
+            if not then:
+                continue
+            changes = []
+            for key in ['p50_ms', 'p99_ms', 'throughput_rps', 'queries_per_request']:
+                if then.get(key) and now.get(key) is not None:
+                    changes.append('{} {:+.1f}%'.format(key, (now[key] - then[key]) / then[key] * 100))
+            print('{:>9} {:>10} {}'.format(mode, name, ', '.join(changes)), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the journal against a seeded database.')
+    parser.add_argument('--mongo', help='MongoDB URI to seed and use (default: in-process mongomock)')
+    parser.add_argument('--sqlite', help='SQLite file to seed and use instead, DROPPED before seeding')
+    parser.add_argument('--db', default='journal_bench', help='database name, DROPPED before seeding')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--entries', type=int, default=200, help='entries per user')
+    parser.add_argument('--paragraphs', type=int, default=5, help='at most this many paragraphs per entry')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests before each scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='client threads')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated')
+    parser.add_argument('--trace', help='also replay this recorded JSONL trace as the "trace" scenario')
+    parser.add_argument('--gunicorn', action='store_true', help='also run against real gunicorn (needs --mongo)')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='-', help='where the JSON goes (default: stdout)')
+    parser.add_argument('--baseline', help='earlier JSON output to compare against')
+    args = parser.parse_args()
+    if args.gunicorn and not (args.mongo or args.sqlite):
+        parser.error('--gunicorn needs a real database (--mongo or --sqlite), the workers are separate processes')
+
+    counter = QueryCounter()
+    if args.sqlite:
+        from journal.db.storage.sqlite import SQLiteCollection
+        count_calls(SQLiteCollection, counter)
+    elif not args.mongo:
+        use_mongomock(counter)
+
+    scenarios = {name: SCENARIOS[name] for name in args.scenarios.split(',') if name}
+    if args.trace:
+        scenarios['trace'] = trace_scenario(args.trace)
+
+    app = journal.create_app(**make_settings(args, counter))
+    users = seed(app, args, random.Random(args.seed))
+
+    results = {'flask': run_all(FlaskDriver(app), scenarios, users, args, lambda: counter.count)}
+    if args.gunicorn:
+        results['gunicorn'] = run_gunicorn(args, scenarios, users)
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.now(tz=pytz.UTC).isoformat(), 'python': platform.python_version(),
+            'database': 'sqlite' if args.sqlite else 'mongodb' if args.mongo else 'mongomock',
+            'commit': _git_revision(),
+            'params': {k: v for k, v in vars(args).items() if k not in ['output', 'baseline']},
+        },
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+    out = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(out)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,65 @@
 import yaml
 from flask import Flask, request
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from journal.db import DatabaseInterface
 from journal.db.util import JWTEncoder
+from journal.helpers import metrics, ratelimit, recaptcha
 from journal.modules import web, api
 
 
 def create_app(**settings) -> Flask:
     recaptcha_enabled = settings.get('recaptcha_enabled', True)
 
+    mongo_options = dict(settings.get('mongodb_options') or {})
+    if settings.get('metrics_enabled', False):
+        mongo_options['event_listeners'] = list(mongo_options.get('event_listeners', [])) + [metrics.CommandListener()]
+
     db = DatabaseInterface(
-        settings['mongodb_uri'], settings['mongodb_db'], settings['idgen_worker_id'], settings['secret_key']
+        settings['mongodb_uri'], settings['mongodb_db'], settings['idgen_worker_id'], settings['secret_key'],
+        mongo_options=mongo_options,
+        user_cache_size=settings.get('user_cache_size', 1024), user_cache_ttl=settings.get('user_cache_ttl', 30),
+        html_cache_bytes=settings.get('html_cache_bytes', 32 * 1024 * 1024),
+        change_streams=settings.get('change_streams', False), argon2_options=settings.get('argon2'),
+        storage_backend=settings.get('storage_backend', 'mongodb'), sqlite_path=settings.get('sqlite_path'),
     )
 
+    if settings.get('auto_migrate', True):
+        db.ensure_indexes()
+        db.close()  # with --preload this ran in the master, don't leave it holding sockets
+
     app = Flask(__name__, static_folder=None)
+    # rate limits key on the client address, only believe X-Forwarded-For as far as our own proxies set it
+    if settings.get('proxy_count', 0):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=settings['proxy_count'])
 
     app.db = db
 
     app.recaptcha_enabled = recaptcha_enabled
     if app.recaptcha_enabled:
-        app.recaptcha = {'secret': settings['recaptcha_secret'], 'site': settings['recaptcha_site']}
+        app.recaptcha = recaptcha.Verifier(
+            settings['recaptcha_secret'], settings['recaptcha_site'],
+            verify_url=settings.get('recaptcha_verify_url') or recaptcha.DEFAULT_VERIFY_URL,
+            connect_timeout=settings.get('recaptcha_connect_timeout', 2),
+            read_timeout=settings.get('recaptcha_read_timeout', 5),
+            fail_open=settings.get('recaptcha_fail_open', False),
+            pool_size=settings.get('recaptcha_pool_size', 8),
+            cache_ttl=settings.get('recaptcha_cache_ttl', 120),
+        )
+
+    app.config['RATELIMIT_ENABLED'] = settings.get('ratelimit_enabled', True)
+    app.config['RATELIMIT_STORAGE_URI'] = settings.get('ratelimit_storage_uri') or ratelimit.DEFAULT_STORAGE_URI
+    app.ratelimits = dict(ratelimit.DEFAULT_LIMITS, **(settings.get('ratelimits') or {}))
+    ratelimit.limiter.init_app(app)
+
+    if settings.get('metrics_enabled', False):
+        metrics.init_app(app, server_timing=settings.get('metrics_server_timing', False),
+                         token=settings.get('metrics_token'))
+
+    if db.watcher:
+        @app.before_request
+        def start_watcher():
+            db.watcher.ensure_running()
 
     app.register_blueprint(web.bp)
     app.register_blueprint(api.bp)
@@ -35,15 +75,53 @@ def create_app(**settings) -> Flask:
     return app
 
 
-def create_app_from_config_file(path='config.yml'):
+def create_asgi_app(**settings):
+    """The same app for ASGI servers, with the API's hot read paths running natively async, see asgi.py."""
+    from journal.modules.api.asgi import AsyncAPI
+    return AsyncAPI(create_app(**settings), threads=settings.get('asgi_threads', 32))
+
+
+def create_app_from_config_file(path='config.yml', **overrides):
+    return create_app(**load_config(path, **overrides))
+
+
+def create_asgi_app_from_config_file(path='config.yml', **overrides):
+    return create_asgi_app(**load_config(path, **overrides))
+
+
+def load_config(path='config.yml', **overrides) -> dict:
+    """Reads config.yml into create_app() settings, filling in the defaults."""
     data = yaml.safe_load(open(path))
-    app = create_app(
-        idgen_worker_id=data.get('idgen_worker_id', 0),
+    data.update(overrides)
+    return dict(
+        idgen_worker_id=data.get('idgen_worker_id', 'auto'),
+        storage_backend=data.get('storage_backend', 'mongodb'),
+        sqlite_path=data.get('sqlite_path', 'journal.sqlite3'),
         mongodb_db=data.get('mongodb_db', 'journal'),
         mongodb_uri=data.get('mongodb_uri', 'mongodb://localhost'),
+        mongodb_options=data.get('mongodb_options'),
         recaptcha_secret=data.get('recaptcha_secret', '6LeIxAcTAAAAAGG-vFI1TnRWxMZNFuojJ4WifJWe'),
         recaptcha_site=data.get('recaptcha_site', '6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI'),
         recaptcha_enabled=data.get('recaptcha_enabled', True),
+        recaptcha_verify_url=data.get('recaptcha_verify_url'),
+        recaptcha_connect_timeout=data.get('recaptcha_connect_timeout', 2),
+        recaptcha_read_timeout=data.get('recaptcha_read_timeout', 5),
+        recaptcha_fail_open=data.get('recaptcha_fail_open', False),
+        recaptcha_pool_size=data.get('recaptcha_pool_size', 8),
+        recaptcha_cache_ttl=data.get('recaptcha_cache_ttl', 120),
+        auto_migrate=data.get('auto_migrate', True),
+        user_cache_size=data.get('user_cache_size', 1024),
+        user_cache_ttl=data.get('user_cache_ttl', 30),
+        html_cache_bytes=data.get('html_cache_bytes', 32 * 1024 * 1024),
+        change_streams=data.get('change_streams', False),
+        argon2=data.get('argon2'),
+        ratelimit_enabled=data.get('ratelimit_enabled', True),
+        ratelimit_storage_uri=data.get('ratelimit_storage_uri'),
+        ratelimits=data.get('ratelimits'),
+        proxy_count=data.get('proxy_count', 0),
+        metrics_enabled=data.get('metrics_enabled', False),
+        metrics_server_timing=data.get('metrics_server_timing', False),
+        metrics_token=data.get('metrics_token'),
+        asgi_threads=data.get('asgi_threads', 32),
         secret_key=data['secret_key'],
     )
-    return app
@@ -0,0 +1,73 @@
+import time
+
+import collections
+import typing
+from threading import Lock
+
+
+class LRUCache:
+    """A small thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+
+    A ``maxsize`` of 0 turns it into a no-op, which keeps call sites free of ``if cache:`` checks.
+    With ``max_bytes`` set, ``sizeof(value)`` is also kept under that budget.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: typing.Optional[float] = None, *,
+                 max_bytes: typing.Optional[int] = None, sizeof: typing.Callable[[typing.Any], int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._sizeof = sizeof or (lambda value: 0)
+        self._bytes = 0
+        self._data = collections.OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= self._sizeof(item[1])
+        return item
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if self.maxsize <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (expires, value)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key):
+        with self._lock:
+            item = self._remove(key)
+        return item[1] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {'size': len(self), 'maxsize': self.maxsize, 'bytes': self._bytes, 'hits': self.hits,
+                'misses': self.misses}
@@ -1,3 +1,4 @@
-from .entry import Entry
+from .page import Page
+from .entry import ConflictError, Entry, EntrySummary
 from .user import User
 from .interface import DatabaseInterface
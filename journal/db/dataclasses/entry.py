@@ -1,3 +1,4 @@
+import datetime
 import pymongo.results
 import pytz
 import typing
@@ -8,6 +9,13 @@ from journal.db.util import id_to_time
 if typing.TYPE_CHECKING:
     from journal.db import DatabaseInterface, User
 
+# how long deletions are remembered for sync clients, anyone older has to start over
+TOMBSTONE_TTL = datetime.timedelta(days=90)
+
+
+class ConflictError(Exception):
+    """Raised when an entry was changed (or deleted) by someone else since it was loaded."""
+
 
 class Entry(Slots):
     def __init__(self, db: 'DatabaseInterface' = None, **data):
@@ -20,6 +28,13 @@ class Entry(Slots):
         self._title = data.get('title') or 'Untitled entry'
         self._content = data.get('content') or ''
         self._tags = data.get('tags') or []
+        self._committed_tags = list(self._tags)  # to tell the per-user tag index what changed
+        # bumped on every commit, a commit only succeeds against the revision it was based on
+        self.revision = data.get('revision') or 0
+        # a fresh snowflake on every write, which makes it a per-entry change sequence for sync
+        self.updated = data.get('updated') or self.id
+        # fields changed since the last load/commit, only these are sent on commit()
+        self._dirty = set()
 
     def serialize(self) -> typing.Dict[str, typing.Any]:
         """Returns a MongoDB-friendly dictionary for a replace() call."""
@@ -31,6 +46,8 @@ class Entry(Slots):
             'tags': self._tags,
             'timestamp': self.timestamp,
             'timezone': (self.timestamp.tzinfo or pytz.UTC).zone,
+            'revision': self.revision,
+            'updated': self.updated,
         }
 
     def to_json(self) -> dict:
@@ -38,11 +55,48 @@ class Entry(Slots):
         data['timestamp'] = data['timestamp'].isoformat()
         return data
 
-    def commit(self) -> pymongo.results.UpdateResult:
-        res = self.db.entries.replace_one({'_id': self.id}, self.serialize())
-        assert res.matched_count == 1
+    def commit(self) -> typing.Optional[pymongo.results.UpdateResult]:
+        """Writes changed fields back. Returns None without touching the database if nothing changed.
+
+        Raises ConflictError if the stored entry is no longer at our revision.
+        """
+        spec = self.update_spec()
+        if spec is None:
+            return
+
+        res = self.db.entries.update_one(*spec)
+        if res.matched_count != 1:
+            raise ConflictError('This entry was changed or deleted somewhere else in the meantime.')
+        content_changed = 'content' in self._dirty
+        self.db.adjust_tags(self._author_id, *self.mark_committed(spec))
+        if content_changed:
+            self.db.render(self, refresh=True)  # we're usually redirected to the view page next anyway
         return res
 
+    def update_spec(self) -> typing.Optional[typing.Tuple[dict, dict]]:
+        """Returns the (filter, update) pair commit() sends, or None if there's nothing to write.
+
+        Every call stages a new change sequence number, so use each result for one write only.
+        """
+        if not self._dirty:
+            return
+
+        data = self.serialize()
+        changes = {k: data[k] for k in self._dirty}
+        changes['updated'] = self.db.id_gen.generate()
+        # entries from before revisions existed don't have the field at all
+        revision = self.revision if self.revision else {'$in': [0, None]}
+        return {'_id': self.id, 'revision': revision}, {'$set': changes, '$inc': {'revision': 1}}
+
+    def mark_committed(self, spec: typing.Tuple[dict, dict]) -> typing.Tuple[list, list]:
+        """Bookkeeping once the update from update_spec() went through. Returns the tags added and removed."""
+        self.revision += 1
+        self.updated = spec[1]['$set']['updated']
+        if 'content' in self._dirty:
+            self.db.html_cache.pop(self.id)
+        self._dirty.clear()
+        return self._tag_changes()
+
     @property
     def author_id(self) -> typing.Optional[int]:
         return self._author_id
@@ -53,8 +107,10 @@ class Entry(Slots):
 
     @author.setter
     def author(self, value: 'User'):
-        # noinspection PyAttributeOutsideInit
-        self._author_id = value.id
+        if value.id != self._author_id:
+            # noinspection PyAttributeOutsideInit
+            self._author_id = value.id
+            self._dirty.add('author_id')
 
     @property
     def title(self):
@@ -66,8 +122,9 @@ class Entry(Slots):
 
     @title.setter
     def title(self, value):
-        if value:
+        if value and value.strip() != self._title:
             self._title = value.strip()
+            self._dirty.add('title')
 
     @property
     def content(self):
@@ -75,8 +132,13 @@ class Entry(Slots):
 
     @content.setter
     def content(self, value):
-        if value:
+        if value and value.strip() != self._content:
             self._content = value.strip()
+            self._dirty.add('content')
+
+    @property
+    def html(self) -> str:
+        return self.db.render(self)
 
     @property
     def tags(self):
@@ -85,7 +147,10 @@ class Entry(Slots):
     @tags.setter
     def tags(self, value: typing.List[str]):
         # we transform from list -> set -> list to remove duplicates
-        self._tags = list(set(sorted(x.strip().lower() for x in value if x.strip())))
+        tags = list(set(sorted(x.strip().lower() for x in value if x.strip())))
+        if set(tags) != set(self._tags):
+            self._tags = tags
+            self._dirty.add('tags')
 
     @property
     def tags_human(self):
@@ -100,12 +165,30 @@ class Entry(Slots):
     def new(self) -> 'Entry':
         """Initializes the database record and returns itself."""
         self.db.entries.insert_one(self.serialize())
+        self._committed_tags = []
+        self._dirty.clear()
+        self.db.adjust_tags(self._author_id, *self._tag_changes())
         return self
 
+    def _tag_changes(self) -> typing.Tuple[list, list]:
+        old, new = set(self._committed_tags), set(self._tags)
+        self._committed_tags = list(self._tags)
+        return list(new - old), list(old - new)
+
+    def tombstone(self) -> dict:
+        """The record that lets sync clients find out about this entry's deletion."""
+        return {
+            'author_id': self._author_id, 'updated': self.db.id_gen.generate(),
+            'deleted_at': datetime.datetime.now(tz=pytz.UTC),
+        }
+
     def delete(self):
         """Clears the database record"""
         res = self.db.entries.delete_one({'_id': self.id})
         assert res.deleted_count == 1
+        self.db.tombstones.replace_one({'_id': self.id}, self.tombstone(), upsert=True)
+        self.db.html_cache.pop(self.id)
+        self.db.adjust_tags(self._author_id, removed=self._committed_tags)
 
     def can_access(self, user: 'User') -> bool:
         """Returns whether a user has access to this entry or not."""
@@ -117,3 +200,38 @@ class Entry(Slots):
 
     def __repr__(self):
         return '<Entry id={0.id!r} author_id={0.author_id!r} title={0.title!r}>'.format(self)
+
+
+class EntrySummary(Slots):
+    """A read-only slice of an entry for list views, without the content."""
+
+    PROJECTION = {'_id': True, 'author_id': True, 'title': True, 'tags': True, 'timestamp': True, 'timezone': True}
+
+    def __init__(self, **data):
+        self.id = data['_id']
+        self.author_id = data.get('author_id')
+        self.title = data.get('title') or 'Untitled entry'
+        self.tags = data.get('tags') or []
+        # stays in UTC until someone actually wants to display it
+        self.timestamp = data.get('timestamp') or id_to_time(self.id)
+        self.timezone = data.get('timezone') or 'UTC'
+        # only set for search results
+        self.score = data.get('score')
+        self.snippet = None
+
+    @property
+    def timestamp_human(self):
+        return self.timestamp.astimezone(pytz.timezone(self.timezone)).strftime('%Y-%m-%d %H:%M:%S %Z')
+
+    def to_json(self) -> dict:
+        data = {
+            'id': self.id, 'author_id': self.author_id, 'title': self.title, 'tags': self.tags,
+            'timestamp': self.timestamp.isoformat(),
+        }
+        if self.score is not None:
+            data['score'] = self.score
+            data['snippet'] = self.snippet
+        return data
+
+    def __repr__(self):
+        return '<EntrySummary id={0.id!r} author_id={0.author_id!r} title={0.title!r}>'.format(self)
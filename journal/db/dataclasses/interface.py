@@ -1,47 +1,139 @@
-# noinspection PyPackageRequirements
-import argon2
+import collections
+import datetime
+import hashlib
+import itertools
 import jwt
+import mistune
+import os
 import pymongo
+import pymongo.database
 import pymongo.errors
 import pytz
+import threading
 import typing
-from bson.codec_options import CodecOptions
 
+from journal.db import migrations, storage
+from journal.db.cache import LRUCache
+from journal.db.hashing import PasswordPool
+from journal.db.leases import WorkerLease
 from journal.db.dataclasses import User, Entry
-from journal.db.util import IDGenerator, JWTEncoder
+from journal.db.util import IDGenerator, JWTEncoder, id_to_time
+from journal.db.watcher import ChangeWatcher
+from journal.helpers import metrics
+
+IMPORT_BATCH_SIZE = 500
 
 
 class DatabaseInterface:
-    def __init__(self, mongo_uri, db_name, worker_id, signing_key):
-        # noinspection PyArgumentList
-        options = CodecOptions(tz_aware=True, tzinfo=pytz.UTC)
-        self.db = pymongo.MongoClient(mongo_uri).get_database(db_name, codec_options=options)
+    def __init__(self, mongo_uri, db_name, worker_id, signing_key, *, mongo_options=None, user_cache_size=1024,
+                 user_cache_ttl=30, html_cache_bytes=32 * 1024 * 1024, change_streams=False, argon2_options=None,
+                 storage_backend='mongodb', sqlite_path=None):
+        # connections are opened on first use in each process, see _connect()
+        self.backend = storage.create_backend(storage_backend, mongo_uri=mongo_uri, db_name=db_name,
+                                              mongo_options=mongo_options, sqlite_path=sqlite_path)
+        self._pid = None
+        self._connect_lock = threading.Lock()
+        self._collections = {}
 
-        self.users = self.db.get_collection('users')
-        self.users.create_index([('username', pymongo.ASCENDING)], unique=True)
+        self.passwords = PasswordPool(**(argon2_options or {}))
+        if worker_id == 'auto':  # every process leases its own from the database
+            self.id_gen = IDGenerator(lease=WorkerLease(self))
+        else:
+            self.id_gen = IDGenerator(int(worker_id))
+        self.jwt = JWTEncoder(signing_key)
+        # token -> user resolution happens on every request, so we keep recently seen users around
+        self.user_cache = LRUCache(user_cache_size, user_cache_ttl)
+        # entry ID -> (content hash, rendered HTML), markdown rendering is the expensive part of viewing entries
+        self.markdown = mistune.Markdown()
+        self.html_cache = LRUCache(65536 if html_cache_bytes else 0, max_bytes=html_cache_bytes,
+                                   sizeof=lambda value: len(value[1]))
 
-        self.entries = self.db.get_collection('entries')
-        self.entries.create_index([('author_id', pymongo.ASCENDING)])
-        self.entries.create_index([('timestamp', pymongo.DESCENDING)])
+        # lets the caches above be invalidated by writes from other workers/hosts
+        self.watcher = None
+        if change_streams and self.backend.supports_change_streams:
+            self.watcher = ChangeWatcher(self)
+            self.watcher.register('users', self.user_cache)
+            self.watcher.register('entries', self.html_cache)
 
-        self.argon2 = argon2.PasswordHasher()
-        self.id_gen = IDGenerator(int(worker_id))
-        self.jwt = JWTEncoder(signing_key)
+    def _connect(self):
+        # MongoClient isn't fork-safe, so a worker forked off a preloaded master must not reuse the master's
+        with self._connect_lock:
+            if self._pid == os.getpid():
+                return
+            self._collections = self.backend.connect()
+            self._pid = os.getpid()
 
-    def create_user(self, username: str, password: str) -> User:
-        _id = self.id_gen.generate()
-        self.users.insert_one({'_id': _id})
+    def close(self):
+        """Drops this process' connections, the next query reconnects."""
+        with self._connect_lock:
+            if self._pid == os.getpid():
+                self.backend.close()
+            self._collections = {}
+            self._pid = None
 
-        new = self.get_user(id=_id)
-        new.password = password
-        del password  # *shudder*
-        try:
+    def drop(self):
+        """Deletes every collection's documents and indexes. Only for benchmarks and throwaway databases."""
+        if self._pid != os.getpid():
+            self._connect()
+        self.backend.drop()
+        self.user_cache.clear()
+        self.html_cache.clear()
+
+    @property
+    def client(self) -> typing.Optional[pymongo.MongoClient]:
+        """The MongoClient underneath, None with other storage backends."""
+        if self._pid != os.getpid():
+            self._connect()
+        return self.backend.client
+
+    @property
+    def db(self) -> typing.Optional[pymongo.database.Database]:
+        if self._pid != os.getpid():
+            self._connect()
+        return self.backend.database
+
+    def _collection(self, name):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._collections[name]
+
+    @property
+    def users(self):
+        return self._collection('users')
+
+    @property
+    def entries(self):
+        return self._collection('entries')
+
+    @property
+    def tags(self):
+        return self._collection('tags')
+
+    @property
+    def tombstones(self):
+        return self._collection('tombstones')
+
+    @property
+    def leases(self):
+        return self._collection('leases')
+
+    @property
+    def meta(self):
+        return self._collection('meta')
+
+    def ensure_indexes(self) -> int:
+        """Brings indexes up to date, costing a single read once they are."""
+        return migrations.migrate(self)
+
+    def create_user(self, username: str, password: str) -> User:
+        new = User(self, _id=self.id_gen.generate())
+        # nothing touches the database until the single insert below, so failures leave nothing behind
+        with new.batch(commit=False):
+            new.password = password
+            del password  # *shudder*
             new.username = username
-        except AssertionError as e:
-            new.delete()
-            raise e
 
-        return new
+        return new.new()
 
     # noinspection PyShadowingBuiltins
     def get_user(self, *, id=None, username=None, token=None) -> typing.Optional[User]:
@@ -52,16 +144,16 @@ class DatabaseInterface:
         if id:
             data = self.users.find_one({'_id': id})
         if token:  # ! special case
-            try:
-                token_data = self.jwt.decode(token)
-            except jwt.InvalidTokenError:
+            token_data = self.token_claims(token)
+            if token_data is None:
                 return
-            for f in ['uid', 'rev']:
-                if f not in token_data:
-                    return
+            cached = self.user_cache.get(token_data['uid'])
+            if cached is not None and cached['token_revision'] == token_data['rev']:
+                return User(self, **cached)  # fresh object every time, callers mutate these
             user = self.get_user(id=token_data['uid'])
             if not user:  # might happen, user could've deleted their account
                 return
+            self.user_cache.put(user.id, user.serialize())
             if user.token_revision != token_data['rev']:  # invalidate old tokens
                 return
             return user
@@ -75,11 +167,260 @@ class DatabaseInterface:
 
         return User(self, **data)
 
-    def create_entry(self, user: User) -> Entry:
-        return Entry(self, timezone=user.timezone.zone, author_id=user.id).new()
+    def token_claims(self, token: str) -> typing.Optional[dict]:
+        """Decodes a session token, None if it isn't one of ours."""
+        try:
+            with metrics.span('jwt'):
+                data = self.jwt.decode(token)
+        except jwt.InvalidTokenError:
+            return
+        if any(f not in data for f in ['uid', 'rev']):
+            return
+        return data
+
+    def render(self, entry: Entry, refresh=False) -> str:
+        """Renders an entry's markdown, reusing the last result as long as the content hasn't changed."""
+        digest = hashlib.blake2b(entry.content.encode(), digest_size=16).digest()
+        cached = None if refresh else self.html_cache.get(entry.id)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+
+        with metrics.span('markdown'):
+            html = self.markdown(entry.content)
+        self.html_cache.put(entry.id, (digest, html))
+        return html
+
+    def adjust_tags(self, author_id: int, added=(), removed=()):
+        """Keeps the per-user tag index (tag -> count, last use) in step with entry changes.
+
+        Tags may repeat, e.g. when several entries of a bulk write gained the same one.
+        """
+        delta = collections.Counter(added)
+        delta.subtract(removed)
+        now = datetime.datetime.now(tz=pytz.UTC)
+        ops = [pymongo.UpdateOne({'author_id': author_id, 'tag': tag},
+                                 {'$inc': {'count': n}, '$max': {'last_used': now}}, upsert=True)
+               for tag, n in delta.items() if n > 0]
+        ops += [pymongo.UpdateOne({'author_id': author_id, 'tag': tag}, {'$inc': {'count': n}})
+                for tag, n in delta.items() if n < 0]
+        if not ops:
+            return
+        self.tags.bulk_write(ops, ordered=False)
+        shrunk = [tag for tag, n in delta.items() if n < 0]
+        if shrunk:
+            self.tags.delete_many({'author_id': author_id, 'tag': {'$in': shrunk}, 'count': {'$lte': 0}})
+
+    def rebuild_tags(self, author_id: int = None):
+        """Recounts the tag index from scratch, for one user or everyone.
+
+        Safe to run while entries change and from several workers at once: counts are upserted over what's
+        there, and only tags that weren't touched since the recount started are removed.
+        """
+        started = datetime.datetime.now(tz=pytz.UTC)
+        scope = {} if author_id is None else {'author_id': author_id}
+        query = dict(scope, tags={'$exists': True, '$ne': []})
+
+        counts = collections.Counter()
+        last_used = {}
+        for raw in self.entries.find(query, {'author_id': True, 'tags': True}):
+            when = id_to_time(raw['_id'])
+            for tag in raw['tags']:
+                key = (raw['author_id'], tag)
+                counts[key] += 1
+                last_used[key] = max(last_used.get(key, when), when)
+
+        ops = [pymongo.UpdateOne({'author_id': a, 'tag': t}, {'$set': {'count': c, 'last_used': last_used[a, t]}},
+                                 upsert=True) for (a, t), c in counts.items()]
+        for attempt in range(2):
+            if not ops:
+                break
+            try:
+                self.tags.bulk_write(ops, ordered=False)
+                break
+            except pymongo.errors.BulkWriteError as e:
+                # two upserts of the same new tag raced, the loser's one matches the winner's document now
+                if attempt or any(x['code'] != 11000 for x in e.details['writeErrors']):
+                    raise
+                ops = [ops[x['index']] for x in e.details['writeErrors']]
+
+        stale = [raw['_id'] for raw in self.tags.find(dict(scope, last_used={'$lte': started}),
+                                                      {'author_id': True, 'tag': True})
+                 if (raw['author_id'], raw['tag']) not in counts]
+        if stale:
+            self.tags.delete_many({'_id': {'$in': stale}})
+
+    def bulk_entries(self, user: User, operations: typing.Dict[int, dict]) -> typing.Dict[int, dict]:
+        """Applies many entry creations/updates/deletions for one user with a single bulk_write.
+
+        ``operations`` maps a caller-side index to ``{'op': 'create'|'update'|'delete', ...}``, already
+        type-checked. Returns a result for every index, shaped like the single-entry API responses.
+        """
+        results = {}
+        ids = [op['id'] for op in operations.values() if op['op'] != 'create']
+        existing = {}
+        if ids:
+            existing = {raw['_id']: Entry(self, **raw)
+                        for raw in self.entries.find({'_id': {'$in': ids}, 'author_id': user.id})}
+
+        writes, pending, touched = [], [], set()
+        for index, op in sorted(operations.items()):
+            if op['op'] == 'create':
+                entry = Entry(self, timezone=user.timezone.zone, author_id=user.id)
+                _apply_fields(entry, op)
+                writes.append(pymongo.InsertOne(entry.serialize()))
+                pending.append((index, op['op'], entry, None))
+                continue
+
+            entry = existing.get(op['id'])
+            if entry is None:
+                results[index] = {'id': op['id'], 'status': 404, 'error': 'Entry not found.'}
+                continue
+            if entry.id in touched:  # the second write would always conflict with the first
+                results[index] = {'id': entry.id, 'status': 400, 'error': 'Entry appears twice in this batch.'}
+                continue
+            touched.add(entry.id)
+
+            if op['op'] == 'update':
+                if op.get('revision') is not None:
+                    entry.revision = op['revision']
+                _apply_fields(entry, op)
+                spec = entry.update_spec()
+                if spec is None:
+                    results[index] = {'id': entry.id, 'status': 200, 'revision': entry.revision}
+                    continue
+                writes.append(pymongo.UpdateOne(*spec))
+                pending.append((index, op['op'], entry, spec))
+            else:
+                writes.append(pymongo.DeleteOne({'_id': entry.id, 'author_id': user.id}))
+                pending.append((index, op['op'], entry, None))
+
+        failed = {}
+        if writes:
+            try:
+                self.entries.bulk_write(writes, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                failed = {error['index']: error['errmsg'] for error in e.details['writeErrors']}
+
+        # bulk results are only totals, so we look at what actually landed: every update staged a unique
+        # change sequence number, and deleted entries are simply gone
+        check = [entry.id for _, kind, entry, _ in pending if kind != 'create']
+        landed = {}
+        if check:
+            landed = {raw['_id']: raw.get('updated')
+                      for raw in self.entries.find({'_id': {'$in': check}}, {'updated': True})}
+
+        added, removed, tombstones = [], [], []
+        for position, (index, kind, entry, spec) in enumerate(pending):
+            if position in failed:
+                results[index] = {'id': entry.id, 'status': 500, 'error': failed[position]}
+            elif kind == 'create':
+                added += entry.tags
+                results[index] = {'id': entry.id, 'status': 201, 'revision': entry.revision}
+            elif kind == 'update':
+                if landed.get(entry.id) != spec[1]['$set']['updated']:
+                    results[index] = {'id': entry.id, 'status': 409,
+                                      'error': 'This entry was changed or deleted somewhere else in the meantime.'}
+                    continue
+                gained, lost = entry.mark_committed(spec)
+                added += gained
+                removed += lost
+                results[index] = {'id': entry.id, 'status': 200, 'revision': entry.revision}
+            else:
+                if entry.id not in landed:
+                    removed += entry.tags
+                    tombstones.append(pymongo.ReplaceOne({'_id': entry.id}, entry.tombstone(), upsert=True))
+                    self.html_cache.pop(entry.id)
+                results[index] = {'id': entry.id, 'status': 204}
+
+        if tombstones:
+            self.tombstones.bulk_write(tombstones, ordered=False)
+        self.adjust_tags(user.id, added, removed)
+        return results
+
+    def import_entries(self, user: User, entries: typing.Iterable[dict],
+                       batch_size: int = IMPORT_BATCH_SIZE) -> typing.Dict[str, int]:
+        """Restores entries from a backup, ``batch_size`` at a time, so ``entries`` can be an iterator of any length.
+
+        Entries keep their ID when it's free. Ones already in this journal are left alone, ones whose ID is
+        taken by somebody else get a fresh one, dated like the entry so it keeps its place in listings.
+        Returns how many ended up in which of these groups.
+        """
+        counts = {'imported': 0, 'existing': 0, 'renumbered': 0}
+        entries = iter(entries)
+        while True:
+            batch = list(itertools.islice(entries, batch_size))
+            if not batch:
+                return counts
+            self._import_batch(user, batch, counts)
+
+    def _import_batch(self, user: User, batch: typing.List[dict], counts: typing.Dict[str, int]):
+        ids = [x['_id'] for x in batch if x.get('_id')]
+        taken = {}
+        if ids:
+            taken = {raw['_id']: raw['author_id']
+                     for raw in self.entries.find({'_id': {'$in': ids}}, {'author_id': True})}
+
+        docs = []
+        sequence = iter(self.id_gen.generate_many(len(batch)))
+        for data in batch:
+            _id = data.get('_id')
+            if _id in taken and taken[_id] == user.id:
+                counts['existing'] += 1
+                continue
+            # restored entries are news to sync clients, so they all get a fresh change sequence number
+            updated = next(sequence)
+            if _id in taken:
+                counts['renumbered'] += 1
+            if not _id or _id in taken:
+                # listings sort by ID, it has to match the entry's date or old entries would show up on top
+                _id = self.id_gen.generate_at(data['timestamp']) if 'timestamp' in data else updated
+                while _id in taken:
+                    _id = self.id_gen.generate_at(data['timestamp'])
+            fields = {'_id': _id, 'author_id': user.id, 'timezone': user.timezone.zone, 'updated': updated}
+            fields.update({k: data[k] for k in ['timestamp', 'timezone'] if k in data})
+            entry = Entry(self, **fields)
+            _apply_fields(entry, data)
+            taken[entry.id] = user.id  # repeated IDs within the backup count as existing
+            docs.append(entry.serialize())
+        if not docs:
+            return
+
+        try:
+            self.entries.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # somebody got to some of the IDs between our check and the insert, those get fresh ones
+            if any(x['code'] != 11000 for x in e.details['writeErrors']):
+                raise
+            raced = [docs[x['index']] for x in e.details['writeErrors']]
+            for doc, updated in zip(raced, self.id_gen.generate_many(len(raced))):
+                doc['_id'], doc['updated'] = self.id_gen.generate_at(doc['timestamp']), updated
+            self.entries.insert_many(raced)
+            counts['renumbered'] += len(raced)
+
+        self.tombstones.delete_many({'_id': {'$in': [x['_id'] for x in docs]}, 'author_id': user.id})
+        self.adjust_tags(user.id, added=[tag for doc in docs for tag in doc['tags']])
+        counts['imported'] += len(docs)
+
+    def create_entry(self, user: User, **fields) -> Entry:
+        entry = Entry(self, timezone=user.timezone.zone, author_id=user.id)
+        _apply_fields(entry, fields)
+        return entry.new()
 
     def get_entry(self, _id) -> typing.Optional[Entry]:
         entry = self.entries.find_one({'_id': _id})
         if entry is None:
             return
         return Entry(self, **entry)
+
+    def entry_version(self, _id) -> typing.Optional[typing.Tuple[int, int]]:
+        """An entry's author and change sequence number, all it takes to revalidate a cached copy."""
+        raw = self.entries.find_one({'_id': _id}, {'author_id': True, 'updated': True})
+        if raw is None:
+            return
+        return raw['author_id'], raw.get('updated') or raw['_id']  # like Entry.updated
+
+
+def _apply_fields(entry: Entry, data: dict):
+    for field in ['title', 'content', 'tags']:
+        if field in data:
+            setattr(entry, field, data[field])
@@ -0,0 +1,64 @@
+import pymongo
+import typing
+from autoslot import Slots
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def clamp_limit(limit: typing.Optional[int]) -> int:
+    if not limit or limit < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
+
+
+class Page(Slots):
+    """A single slice of a keyset-paginated listing.
+
+    Cursors are snowflake IDs; pass ``next_cursor`` as ``before`` to get older items
+    and ``prev_cursor`` as ``after`` to get newer ones.
+    """
+
+    def __init__(self, items: list, prev_cursor: typing.Optional[int] = None,
+                 next_cursor: typing.Optional[int] = None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<Page len={0} prev_cursor={1.prev_cursor!r} next_cursor={1.next_cursor!r}>'.format(len(self), self)
+
+
+def keyset(query: dict, before: int = None, after: int = None) -> int:
+    """Adds the cursor condition to a listing query, returns the direction to sort ``_id`` in.
+
+    Fetch ``limit + 1`` documents in that order and hand them to keyset_page().
+    """
+    if after:  # walking towards newer entries, so we have to flip the sort and flip the results back
+        query['_id'] = {'$gt': after}
+        return pymongo.ASCENDING
+    if before:
+        query['_id'] = {'$lt': before}
+    return pymongo.DESCENDING
+
+
+def keyset_page(items: list, limit: int, before: int = None, after: int = None) -> Page:
+    # the one extra item tells us whether there's another page without a count query
+    more = len(items) > limit
+    items = items[:limit]
+
+    if after:
+        items.reverse()
+        prev_cursor = items[0].id if more else None
+        next_cursor = items[-1].id if items else after + 1
+    else:
+        prev_cursor = items[0].id if items and before else None
+        next_cursor = items[-1].id if more else None
+
+    return Page(items, prev_cursor, next_cursor)
@@ -1,4 +1,4 @@
-import argon2
+import contextlib
 import datetime
 import pymongo
 import pymongo.errors
@@ -7,12 +7,58 @@ import pytz
 import typing
 from autoslot import Slots
 
-from .entry import Entry
+from .entry import Entry, EntrySummary, TOMBSTONE_TTL
+from .page import Page, clamp_limit, keyset, keyset_page
+from journal.db.util import highlight, search_terms, time_to_id
+
+# writes younger than this may still be overtaken by slower ones with lower IDs (other workers, clock skew),
+# so sync tokens never point past it and clients see that window again next time
+SYNC_SETTLE_TIME = datetime.timedelta(seconds=5)
+EXPORT_BATCH_SIZE = 500
+SYNC_RESET = {'entries': [], 'deleted': [], 'token': 0, 'more': False, 'reset': True}
+TAG_PROJECTION = {'_id': False, 'tag': True, 'count': True, 'last_used': True}
+TAG_SORT = [('count', pymongo.DESCENDING), ('tag', pymongo.ASCENDING)]
 
 if typing.TYPE_CHECKING:
     from journal.db import DatabaseInterface
 
 
+def sync_expired(since: int, now: datetime.datetime) -> bool:
+    """Whether a sync token is too old to know about all deletions since then."""
+    return bool(since) and since < time_to_id(now - TOMBSTONE_TTL)
+
+
+def changes_query(author_id: int, since: int) -> dict:
+    return {'author_id': author_id, 'updated': {'$gt': since or 0}}
+
+
+def merge_changes(db: 'DatabaseInterface', written: typing.List[dict], deleted: typing.List[dict], since: int,
+                  limit: int, now: datetime.datetime) -> typing.Dict[str, typing.Any]:
+    """Builds the User.changes() result from the first ``limit + 1`` entries and tombstones after ``since``."""
+    # both lists are sorted, so the first `limit` changes overall come from their heads
+    merged = sorted([(x['updated'], False, x) for x in written] + [(x['updated'], True, x) for x in deleted],
+                    key=lambda change: change[0])
+    more = len(merged) > limit
+    merged = merged[:limit]
+
+    token = merged[-1][0] if merged else (since or 0)
+    settled = time_to_id(now - SYNC_SETTLE_TIME)
+    if token > settled:
+        held = max(settled, since or 0)
+        # unless a full page lies entirely within the settle window: held back, the client would fetch that same
+        # page over and over, so the token moves past it and takes the (small) risk of missing a write
+        if not more or held >= merged[0][0]:
+            token = held
+
+    return {
+        'entries': [Entry(db, **raw) for _, gone, raw in merged if not gone],
+        'deleted': [raw['_id'] for _, gone, raw in merged if gone],
+        'token': token,
+        'more': more,
+        'reset': False,
+    }
+
+
 class User(Slots):
     def __init__(self, db: 'DatabaseInterface' = None, **data):
         self.db = db
@@ -23,6 +69,7 @@ class User(Slots):
         display_backup = self._username.replace('-', ' ').replace('_', ' ').replace('.', ' ').title()
         self._display_name = data.get('display_name') or display_backup
         self.flags = data.get('flags', [])
+        self._committed_flags = list(self.flags)  # flags is a plain list, so we diff it on commit
         self._timezone = pytz.timezone(data.get('timezone', 'UTC'))
         # tokens
         self._token_revision = data.get('token_revision') or 0
@@ -31,6 +78,11 @@ class User(Slots):
         self._ui_theme = data.get('ui_theme') or 'light'
         self._ui_font_title = data.get('ui_font_title') or 'Lato'
         self._ui_font_body = data.get('ui_font_body') or 'Open Sans'
+        # fields changed since the last load/commit, commit() only sends these
+        self._dirty = set()
+        self._unset = set()
+        self._committed_username = self._username
+        self._batch_depth = 0
 
         settings = data.get('settings', {})
         if settings:
@@ -40,6 +92,10 @@ class User(Slots):
                 self._ui_font_body = settings['body_font']
             if 'theme' in settings:
                 self._ui_theme = settings['theme']
+            # migration, moves these to the top level on the next commit
+            self._dirty.update(['ui_font_title', 'ui_font_body', 'ui_theme'])
+        if 'settings' in data:
+            self._unset.add('settings')
 
     def __repr__(self):
         return '<User username={0.username!r} display_name={0.display_name!r}>'.format(self)
@@ -53,6 +109,7 @@ class User(Slots):
             'flags': self.flags,
             'timezone': self._timezone.zone,
             'token_revision': self.token_revision,
+            'token_expiry': self.token_expiry,
             'ui_theme': self._ui_theme,
             'ui_font_title': self._ui_font_title,
             'ui_font_body': self._ui_font_body,
@@ -63,19 +120,73 @@ class User(Slots):
         data = self.serialize()
         del data['password']  # even though it's hashed, let's not leak it
         del data['token_revision']  # not really interesting to the user or developers
+        del data['token_expiry']
         return data
 
-    def commit(self) -> pymongo.results.UpdateResult:
-        res = self.db.users.replace_one({'_id': self.id}, self.serialize())
+    def commit(self) -> typing.Optional[pymongo.results.UpdateResult]:
+        """Writes changed fields back. Returns None without touching the database if nothing changed."""
+        if self.flags != self._committed_flags:
+            self._dirty.add('flags')
+        if not self._dirty and not self._unset:
+            return
+
+        data = self.serialize()
+        update = {}
+        if self._dirty:
+            update['$set'] = {k: data[k] for k in self._dirty}
+        if self._unset:
+            update['$unset'] = {k: '' for k in self._unset}
+        try:
+            res = self.db.users.update_one({'_id': self.id}, update)
+        except pymongo.errors.DuplicateKeyError:
+            if 'username' not in self._dirty:
+                raise
+            self._username = self._committed_username
+            self._dirty.discard('username')
+            self.commit()  # everything else still deserves to be saved
+            raise AssertionError('Unable to set username: Username is taken.')
+        self.db.user_cache.pop(self.id)
         assert res.matched_count == 1
+        self._mark_clean()
         return res
 
-    def check_pw(self, password: str):
+    def _mark_clean(self):
+        self._dirty.clear()
+        self._unset.clear()
+        self._committed_flags = list(self.flags)
+        self._committed_username = self._username
+
+    def _autocommit(self):
+        """Commits right away, unless we're inside batch()."""
+        if not self._batch_depth:
+            self.commit()
+
+    @contextlib.contextmanager
+    def batch(self, commit=True):
+        """Defers the commits setters would do on their own, so a whole form turns into one update.
+
+        Nothing is written if the block raises. With commit=False, the caller takes care of writing
+        (e.g. via new()) afterwards.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if commit and not self._batch_depth:
+            self.commit()
+
+    def new(self) -> 'User':
+        """Inserts the database record in a single write and returns itself."""
         try:
-            self.db.argon2.verify(self._pw_hash, password)
-            return True
-        except argon2.exceptions.VerificationError:
-            return False
+            self.db.users.insert_one(self.serialize())
+        except pymongo.errors.DuplicateKeyError:
+            raise AssertionError('Unable to set username: Username is taken.')
+        self._mark_clean()
+        return self
+
+    def check_pw(self, password: str):
+        return self.db.passwords.verify(self._pw_hash, password)
 
     @property
     def username(self):
@@ -91,13 +202,9 @@ class User(Slots):
         for char in value:
             if char not in 'abcdefghijklmnopqrstuvwxyz0123456789-_.':
                 raise AssertionError('Unable to set username: Illegal characters.')
-        old_username = self.username
-        try:
-            self._username = value
-            self.commit()
-        except pymongo.errors.DuplicateKeyError:
-            self._username = old_username
-            raise AssertionError('Unable to set username: Username is taken.')
+        self._username = value
+        self._dirty.add('username')
+        self._autocommit()  # commit() reports taken usernames
 
     @property
     def display_name(self):
@@ -105,9 +212,10 @@ class User(Slots):
 
     @display_name.setter
     def display_name(self, value):
-        if not value or not value.strip():
+        if not value or not value.strip() or value.strip() == self._display_name:
             return
         self._display_name = value.strip()
+        self._dirty.add('display_name')
 
     @property
     def password(self):
@@ -118,11 +226,11 @@ class User(Slots):
         if not value or not value.strip():
             return
 
-        password = self.db.argon2.hash(value)
+        password = self.db.passwords.hash(value)
         del value  # get that thing out of memory ASAP
         self._pw_hash = password
-        self.invalidate_tokens()
-        self.commit()
+        self._dirty.add('password')
+        self.invalidate_tokens()  # this commits for us
 
     @property
     def timezone(self):
@@ -134,7 +242,9 @@ class User(Slots):
             return
         if value not in pytz.all_timezones:
             raise AssertionError('Invalid timezone given.')
-        self._timezone = pytz.timezone(value)
+        if value != self._timezone.zone:
+            self._timezone = pytz.timezone(value)
+            self._dirty.add('timezone')
 
     @property
     def token_revision(self) -> int:  # not making a setter for this, making one would be a Bad Idea(tm)
@@ -142,7 +252,9 @@ class User(Slots):
 
     def invalidate_tokens(self):
         self._token_revision += 1  # state-keeping the best we can
-        self.commit()
+        self._dirty.add('token_revision')
+        self.db.user_cache.pop(self.id)  # commit does this too, but revocation shouldn't depend on that
+        self._autocommit()
 
     @property
     def token_expiry(self) -> int:
@@ -155,6 +267,7 @@ class User(Slots):
         if value < 0:
             raise AssertionError('Cannot set a negative value for expiry.')
         self._token_expiry = value
+        self._dirty.add('token_expiry')
         self.invalidate_tokens()  # this commits for us
 
     def create_token(self) -> str:
@@ -163,16 +276,90 @@ class User(Slots):
             additional['exp'] = datetime.datetime.now(tz=pytz.UTC) + datetime.timedelta(seconds=self.token_expiry)
         return self.db.jwt.encode(uid=self.id, rev=self.token_revision, **additional)
 
-    def entries(self, tag=None):
+    def entries(self, tag=None, *, before=None, after=None, limit=None) -> Page:
+        """Returns a page of entries, newest first.
+
+        IDs are time-ordered, so they double as the sort key and the pagination cursor.
+        """
+        query = {'author_id': self.id}
         if tag:
-            cursor = self.db.entries.find({'author_id': self.id, 'tags': tag.lower()})
-        else:
-            cursor = self.db.entries.find({'author_id': self.id})
+            query['tags'] = tag.lower()
 
-        cursor = cursor.sort('timestamp', pymongo.DESCENDING)
+        return self._paginate(query, lambda raw: Entry(self.db, **raw), before=before, after=after, limit=limit)
 
-        for raw_entry in cursor:
-            yield Entry(self.db, **raw_entry)
+    def entry_summaries(self, tag=None, *, before=None, after=None, limit=None) -> Page:
+        """Like entries(), but only fetches what list views need."""
+        query = {'author_id': self.id}
+        if tag:
+            query['tags'] = tag.lower()
+
+        return self._paginate(query, lambda raw: EntrySummary(**raw), projection=EntrySummary.PROJECTION,
+                              before=before, after=after, limit=limit)
+
+    def tags(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Returns this user's tags with their entry counts, most used first."""
+        return list(self.db.tags.find({'author_id': self.id}, TAG_PROJECTION).sort(TAG_SORT))
+
+    def search(self, query: str, *, page: int = 1, limit: int = None) -> Page:
+        """Returns a page of summaries ranked by text relevance, each with a highlighted snippet.
+
+        Relevance has no stable keyset, so the cursors here are page numbers.
+        """
+        limit = clamp_limit(limit)
+        page = max(page or 1, 1)
+
+        projection = dict(EntrySummary.PROJECTION, content=True, score={'$meta': 'textScore'})
+        cursor = self.db.entries.find({'author_id': self.id, '$text': {'$search': query}}, projection) \
+            .sort([('score', {'$meta': 'textScore'})]).skip((page - 1) * limit).limit(limit + 1)
+
+        terms = search_terms(query)
+        items = []
+        for raw in cursor:
+            summary = EntrySummary(**raw)
+            summary.snippet = highlight(raw.get('content') or '', terms)
+            items.append(summary)
+
+        more = len(items) > limit
+        return Page(items[:limit], page - 1 if page > 1 else None, page + 1 if more else None)
+
+    def changes(self, since: int = 0, limit: int = None) -> typing.Dict[str, typing.Any]:
+        """Returns entries written and IDs deleted after the sync token ``since``, oldest change first.
+
+        ``token`` is what to pass as ``since`` next time and ``more`` says whether to do so right away.
+        ``reset`` means the token is too old to know about all deletions, the client has to start over.
+        """
+        now = datetime.datetime.now(tz=pytz.UTC)
+        if sync_expired(since, now):
+            return dict(SYNC_RESET)
+
+        limit = clamp_limit(limit)
+        query = changes_query(self.id, since)
+        written = list(self.db.entries.find(query).sort('updated', pymongo.ASCENDING).limit(limit + 1))
+        deleted = list(self.db.tombstones.find(query, {'updated': True}).sort('updated', pymongo.ASCENDING)
+                       .limit(limit + 1))
+        return merge_changes(self.db, written, deleted, since, limit, now)
+
+    def listing_version(self) -> int:
+        """The newest change sequence number among this user's entries and deletions, it moves on every write.
+
+        Two index-only lookups, cheap enough to answer a conditional GET with.
+        """
+        query = {'author_id': self.id}
+        newest = [raw['updated'] for collection in [self.db.entries, self.db.tombstones]
+                  for raw in collection.find(query, {'updated': True}).sort('updated', pymongo.DESCENDING).limit(1)]
+        return max(newest, default=0)
+
+    def export(self) -> typing.Iterator[Entry]:
+        """Yields every entry, oldest first, straight off the cursor so backups don't need to fit in memory."""
+        cursor = self.db.entries.find({'author_id': self.id}).sort('_id', pymongo.ASCENDING)
+        for raw in cursor.batch_size(EXPORT_BATCH_SIZE):
+            yield Entry(self.db, **raw)
+
+    def _paginate(self, query, factory, *, projection=None, before=None, after=None, limit=None) -> Page:
+        limit = clamp_limit(limit)
+        direction = keyset(query, before, after)
+        cursor = self.db.entries.find(query, projection).sort('_id', direction).limit(limit + 1)
+        return keyset_page([factory(raw) for raw in cursor], limit, before, after)
 
     @property
     def ui_theme(self):
@@ -184,7 +371,9 @@ class User(Slots):
             return
         if value not in ['light', 'dark']:
             raise AttributeError('Invalid theme set.')
-        self._ui_theme = value
+        if value != self._ui_theme:
+            self._ui_theme = value
+            self._dirty.add('ui_theme')
 
     @staticmethod
     def _validate_font(value):
@@ -202,7 +391,9 @@ class User(Slots):
             return
         value = value.strip()
         self._validate_font(value)
-        self._ui_font_title = value
+        if value != self._ui_font_title:
+            self._ui_font_title = value
+            self._dirty.add('ui_font_title')
 
     @property
     def ui_font_body(self):
@@ -214,8 +405,13 @@ class User(Slots):
             return
         value = value.strip()
         self._validate_font(value)
-        self._ui_font_body = value
+        if value != self._ui_font_body:
+            self._ui_font_body = value
+            self._dirty.add('ui_font_body')
 
     def delete(self):
         self.db.users.delete_one({'_id': self.id})
+        self.db.user_cache.pop(self.id)
         self.db.entries.delete_many({'author_id': self.id})
+        self.db.tags.delete_many({'author_id': self.id})
+        self.db.tombstones.delete_many({'author_id': self.id})
@@ -0,0 +1,61 @@
+# noinspection PyPackageRequirements
+import argon2
+import concurrent.futures
+import os
+import threading
+
+from journal.helpers import metrics
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing when too many hashes are already waiting."""
+
+
+class PasswordPool:
+    """Runs argon2 on a small dedicated thread pool so login bursts can't occupy every request thread.
+
+    argon2 releases the GIL while hashing, so threads give us real parallelism here. Anything beyond
+    ``workers`` running plus ``queue`` waiting is refused with :class:`Overloaded` right away.
+    """
+
+    def __init__(self, workers: int = None, queue: int = 16, **argon2_params):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = queue
+        self.hasher = argon2.PasswordHasher(**argon2_params)
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_pool(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # a pool inherited through fork has no threads behind it
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='argon2')
+            self._slots = threading.BoundedSemaphore(self.workers + self.queue)
+            self._pid = os.getpid()
+
+    def _run(self, fn, *args):
+        self._ensure_pool()
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded('Too many password operations in progress, please try again shortly.')
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with metrics.span('argon2'):  # waiting in the queue included, that's what the request feels
+            return future.result()
+
+    def hash(self, password: str) -> str:
+        return self._run(self.hasher.hash, password)
+
+    def verify(self, pw_hash: str, password: str) -> bool:
+        try:
+            return self._run(self.hasher.verify, pw_hash, password)
+        except argon2.exceptions.VerificationError:
+            return False
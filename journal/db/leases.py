@@ -0,0 +1,103 @@
+import atexit
+import datetime
+import logging
+import os
+import pymongo
+import pymongo.errors
+import pytz
+import random
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from journal.db import DatabaseInterface
+    from journal.db.util import IDGenerator
+
+log = logging.getLogger(__name__)
+
+
+class WorkerLease:
+    """Leases a free snowflake worker ID to each process from the ``leases`` collection.
+
+    A lease is a ``{'_id': worker_id, 'holder', 'expires', 'last_ms'}`` document kept alive by a heartbeat
+    thread. Leases of crashed processes simply run out and are taken over, the new holder then continues
+    after the last millisecond its predecessor reported so their IDs can't overlap.
+    """
+
+    def __init__(self, db: 'DatabaseInterface', ttl: float = 60, max_workers: int = 1024):
+        self.db = db
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.max_workers = max_workers
+        self.worker_id = None
+        self._holder = None
+        self._generator = None
+        self._pid = None  # the process holding worker_id, a forked child has to lease its own
+        self._stop = threading.Event()
+
+    def acquire(self, generator: 'IDGenerator') -> typing.Tuple[int, int]:
+        """Claims a worker ID for this process, returns it with the millisecond IDs have to start after."""
+        self._generator = generator
+        self._holder = '{}:{}:{:x}'.format(os.uname().nodename, os.getpid(), random.getrandbits(32))
+        now = datetime.datetime.now(tz=pytz.UTC)
+        taken = {raw['_id']: raw for raw in self.db.leases.find()}
+
+        # never used IDs first, then ones whose holder is gone, random order so starting workers don't collide
+        free = [x for x in range(self.max_workers) if x not in taken]
+        expired = [x for x, raw in taken.items() if raw['expires'] < now]
+        random.shuffle(free)
+        random.shuffle(expired)
+        for worker_id in free + expired:
+            lease = {'holder': self._holder, 'expires': now + self.ttl}
+            try:
+                if worker_id in taken:
+                    previous = self.db.leases.find_one_and_update({'_id': worker_id, 'expires': {'$lt': now}},
+                                                                  {'$set': lease})
+                    if previous is None:
+                        continue
+                    floor = previous.get('last_ms', 0)
+                else:
+                    self.db.leases.insert_one(dict(lease, _id=worker_id, last_ms=0))
+                    floor = 0
+            except pymongo.errors.DuplicateKeyError:  # somebody else was quicker
+                continue
+
+            self.worker_id = worker_id
+            self._start()
+            return worker_id, floor
+        raise RuntimeError('All {} worker IDs are leased.'.format(self.max_workers))
+
+    def _start(self):
+        if self._pid == os.getpid():  # re-leased after losing the old one, the heartbeat is still running
+            return
+        self._pid = os.getpid()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='journal-worker-lease', daemon=True).start()
+        atexit.register(self.release)
+
+    def _run(self):
+        while not self._stop.wait(self.ttl.total_seconds() / 3):
+            try:
+                self.renew()
+            except pymongo.errors.PyMongoError:
+                log.exception('Could not renew worker ID lease %s', self.worker_id)
+
+    def renew(self):
+        res = self.db.leases.update_one({'_id': self.worker_id, 'holder': self._holder}, {'$set': {
+            'expires': datetime.datetime.now(tz=pytz.UTC) + self.ttl, 'last_ms': self._generator.last_ms,
+        }})
+        if res.matched_count != 1:
+            # we were stalled for longer than the TTL and someone took our ID over, so move to another one
+            log.warning('Lost worker ID lease %s, leasing a new one', self.worker_id)
+            self._generator.release_worker_id()
+
+    def release(self):
+        """Hands the ID back right away, keeping where we stopped for the next holder."""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        try:
+            self.db.leases.update_one({'_id': self.worker_id, 'holder': self._holder}, {'$set': {
+                'expires': datetime.datetime.now(tz=pytz.UTC), 'last_ms': self._generator.last_ms,
+            }})
+        except pymongo.errors.PyMongoError:
+            pass  # it'll expire on its own
@@ -0,0 +1,154 @@
+import datetime
+import os
+import pymongo
+import pymongo.errors
+import pytz
+import random
+import time
+import typing
+
+from journal.db.dataclasses.entry import TOMBSTONE_TTL
+
+if typing.TYPE_CHECKING:
+    from journal.db import DatabaseInterface
+
+MIGRATIONS = []
+
+
+def migration(f):
+    """Registers a schema step. Order of definition is order of execution, never reorder or remove these."""
+    MIGRATIONS.append(f)
+    return f
+
+
+@migration
+def compound_indexes(db: 'DatabaseInterface'):
+    db.users.create_index([('username', pymongo.ASCENDING)], unique=True)
+
+    # listings filter by author (and optionally a tag) and sort/paginate on the time-ordered ID
+    db.entries.create_index([('author_id', pymongo.ASCENDING), ('_id', pymongo.DESCENDING)],
+                            name='author_listing')
+    db.entries.create_index([('author_id', pymongo.ASCENDING), ('tags', pymongo.ASCENDING),
+                             ('_id', pymongo.DESCENDING)], name='author_tag_listing')
+
+    # superseded by the above
+    for name in ['author_id_1', 'timestamp_-1']:
+        try:
+            db.entries.drop_index(name)
+        except pymongo.errors.OperationFailure:
+            pass  # never existed, fresh database
+
+
+@migration
+def text_index(db: 'DatabaseInterface'):
+    # the author_id prefix scopes every search to one user's entries, Mongo requires equality on it
+    db.entries.create_index([('author_id', pymongo.ASCENDING), ('title', pymongo.TEXT), ('content', pymongo.TEXT)],
+                            name='author_text', weights={'title': 5, 'content': 1})
+
+
+@migration
+def tag_index(db: 'DatabaseInterface'):
+    db.tags.create_index([('author_id', pymongo.ASCENDING), ('tag', pymongo.ASCENDING)], unique=True,
+                         name='author_tag')
+    db.rebuild_tags()
+
+
+@migration
+def sync_indexes(db: 'DatabaseInterface'):
+    # older entries get their ID as change sequence, it's what they'd have gotten on creation
+    batch = []
+    for raw in db.entries.find({'updated': {'$exists': False}}, {'_id': True}):
+        batch.append(pymongo.UpdateOne({'_id': raw['_id']}, {'$set': {'updated': raw['_id']}}))
+        if len(batch) == 1000:
+            db.entries.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        db.entries.bulk_write(batch, ordered=False)
+
+    db.entries.create_index([('author_id', pymongo.ASCENDING), ('updated', pymongo.ASCENDING)], name='author_sync')
+    db.tombstones.create_index([('author_id', pymongo.ASCENDING), ('updated', pymongo.ASCENDING)],
+                               name='author_sync')
+    db.tombstones.create_index([('deleted_at', pymongo.ASCENDING)], name='expiry',
+                               expireAfterSeconds=int(TOMBSTONE_TTL.total_seconds()))
+
+
+def schema_version(db: 'DatabaseInterface') -> int:
+    state = db.meta.find_one({'_id': 'schema'})
+    return state['version'] if state else 0
+
+
+def migrate(db: 'DatabaseInterface', timeout: float = 600, poll: float = 0.5) -> int:
+    """Runs all pending migrations and returns the resulting schema version.
+
+    Only one process migrates at a time, others starting meanwhile wait for it to finish. A claim not renewed
+    within ``timeout`` seconds (its holder died) is taken over.
+    """
+    version = schema_version(db)
+    if version >= len(MIGRATIONS):
+        return version
+
+    owner = '{}:{}:{:x}'.format(os.uname().nodename, os.getpid(), random.getrandbits(32))
+    ttl = datetime.timedelta(seconds=timeout)
+    try:
+        db.meta.update_one({'_id': 'schema'}, {'$setOnInsert': {'version': 0}}, upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        pass  # somebody else just created it
+
+    while True:
+        now = datetime.datetime.now(tz=pytz.UTC)
+        state = db.meta.find_one_and_update(
+            {'_id': 'schema', '$or': [{'expires': {'$exists': False}}, {'expires': {'$lt': now}}]},
+            {'$set': {'owner': owner, 'expires': now + ttl}}, return_document=pymongo.ReturnDocument.AFTER)
+        if state is not None:
+            break
+        time.sleep(poll)  # claimed by another process, its steps count as ours once it's done
+        version = schema_version(db)
+        if version >= len(MIGRATIONS):
+            return version
+
+    version = state['version']
+    try:
+        for step in MIGRATIONS[version:]:
+            step(db)
+            version += 1
+            # renews the claim as well, a step is expected to take less than the timeout
+            result = db.meta.update_one({'_id': 'schema', 'owner': owner}, {'$set': {
+                'version': version, 'expires': datetime.datetime.now(tz=pytz.UTC) + ttl,
+            }})
+            if not result.matched_count:
+                raise RuntimeError('Lost the migration claim to another process after version {}.'.format(version))
+    finally:
+        db.meta.update_one({'_id': 'schema', 'owner': owner},
+                           {'$set': {'expires': datetime.datetime.now(tz=pytz.UTC)}})
+    return version
+
+
+def winning_index(plan: dict) -> typing.Optional[str]:
+    """Digs the index name out of an explain() result, None meaning a collection scan."""
+    stage = plan.get('queryPlanner', {}).get('winningPlan', {})
+    while stage:
+        if 'indexName' in stage:
+            return stage['indexName']
+        stage = stage.get('inputStage') or (stage.get('inputStages') or [None])[0]
+    return None
+
+
+def listing_index(db: 'DatabaseInterface', author_id: int, tag: str = None) -> typing.Optional[str]:
+    """Returns the index the entry listing query would use, to catch regressions to collection scans."""
+    query = {'author_id': author_id}
+    if tag:
+        query['tags'] = tag
+    return winning_index(db.entries.find(query).sort('_id', pymongo.DESCENDING).limit(1).explain())
+
+
+def check_listing_indexes(db: 'DatabaseInterface', author_id: int, tag: str) -> typing.List[str]:
+    """Explains both entry listing queries, returns what's wrong (empty if they hit their indexes)."""
+    problems = []
+    # without multikey indexes author_tag_listing is just author_listing, and the tag a filter on top
+    tag_index = 'author_tag_listing' if db.backend.supports_array_indexes else 'author_listing'
+    for query_tag, expected in [(None, 'author_listing'), (tag, tag_index)]:
+        used = listing_index(db, author_id, query_tag)
+        if used != expected:
+            problems.append('listing{} uses {} instead of {}'.format(
+                ' by tag' if query_tag else '', used or 'COLLSCAN', expected))
+    return problems
@@ -0,0 +1,48 @@
+"""Storage backends underneath DatabaseInterface.
+
+A backend hands out one object per collection, and those objects speak the part of pymongo's ``Collection``
+API the journal uses (find/sort/limit, the update operators, bulk_write, indexes, ...). The Mongo backend
+passes real collections through, the SQLite one implements that subset on an embedded database file.
+"""
+import typing
+
+COLLECTIONS = ['users', 'entries', 'tags', 'tombstones', 'meta', 'leases']
+BACKENDS = ['mongodb', 'sqlite']
+
+
+class StorageBackend:
+    # whether DatabaseInterface.db.watch() works, see ChangeWatcher
+    supports_change_streams = False
+    # whether list fields (tags) can be part of an index, otherwise such indexes leave them out
+    supports_array_indexes = False
+
+    def connect(self) -> typing.Dict[str, typing.Any]:
+        """Opens this process' connection, returns the collections by name."""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def drop(self):
+        """Deletes all data, for benchmarks and throwaway databases."""
+        raise NotImplementedError
+
+    @property
+    def client(self):
+        """The driver object underneath, if there is one worth talking to directly."""
+        return None
+
+    @property
+    def database(self):
+        return None
+
+
+def create_backend(name: str, *, mongo_uri=None, db_name=None, mongo_options=None,
+                   sqlite_path=None) -> StorageBackend:
+    if name == 'mongodb':
+        from journal.db.storage.mongo import MongoBackend
+        return MongoBackend(mongo_uri, db_name, mongo_options)
+    if name == 'sqlite':
+        from journal.db.storage.sqlite import SQLiteBackend
+        return SQLiteBackend(sqlite_path)
+    raise ValueError('Unknown storage backend {!r}, expected one of {}.'.format(name, ', '.join(BACKENDS)))
@@ -0,0 +1,40 @@
+import pymongo
+import pymongo.database
+import pytz
+from bson.codec_options import CodecOptions
+
+from journal.db.storage import COLLECTIONS, StorageBackend
+
+
+class MongoBackend(StorageBackend):
+    supports_change_streams = True
+    supports_array_indexes = True
+
+    def __init__(self, uri: str, db_name: str, options: dict = None):
+        self.uri = uri
+        self.db_name = db_name
+        self.options = options or {}
+        self._client = self._db = None
+
+    def connect(self):
+        self._client = pymongo.MongoClient(self.uri, **self.options)
+        # noinspection PyArgumentList
+        options = CodecOptions(tz_aware=True, tzinfo=pytz.UTC)
+        self._db = self._client.get_database(self.db_name, codec_options=options)
+        return {name: self._db.get_collection(name) for name in COLLECTIONS}
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+        self._client = self._db = None
+
+    def drop(self):
+        self._client.drop_database(self.db_name)
+
+    @property
+    def client(self) -> pymongo.MongoClient:
+        return self._client
+
+    @property
+    def database(self) -> pymongo.database.Database:
+        return self._db
@@ -0,0 +1,740 @@
+"""Embedded storage: the journal's slice of MongoDB's collection API on top of a single SQLite file.
+
+Every collection is a table of JSON documents keyed by ``_id``. Indexes become expression indexes over
+``json_extract()``, the text index an FTS5 table kept in step with its collection, so queries keep their Mongo
+shape everywhere above this module. Anything the journal doesn't use raises NotImplementedError.
+"""
+import bson
+import contextlib
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import typing
+
+import pymongo
+import pymongo.errors
+import pymongo.results
+import pytz
+
+from journal.db.storage import COLLECTIONS, StorageBackend
+
+# datetimes are stored as marked ISO strings in UTC, those compare and sort just like the datetimes do
+DATE_MARK = '\x01D'
+# real strings starting with \x01 get a mark of their own so they aren't mistaken for anything else
+STRING_MARK = '\x01S'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# fields holding lists, where Mongo matches a query value against each element
+ARRAY_FIELDS = {'tags'}
+INDEX_TABLE = '_journal_indexes'
+TTL_INTERVAL = 60  # seconds between purges of expired documents, what MongoDB's TTL monitor does too
+BUSY_TIMEOUT = 10  # seconds a write waits for another process' transaction
+DUPLICATE_KEY = 11000
+INDEX_NOT_FOUND = 27
+_FIELD = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+_SEARCH = re.compile(r'(-?)"([^"]*)"?|(\S+)')
+
+
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path: str):
+        self.path = path or 'journal.sqlite3'
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pid = None
+        self._schema_version = None
+        self._indexes = {}  # collection -> {'text': (table, fields, weights), 'ttl': [(field, seconds)]}
+        self._purged = {}
+
+    def connect(self):
+        with self.transaction() as conn:
+            _create_tables(conn)
+        return {name: SQLiteCollection(self, name) for name in COLLECTIONS}
+
+    def connection(self) -> sqlite3.Connection:
+        """This thread's connection, each thread gets its own."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        # autocommit, transactions are explicit, see transaction()
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')  # readers never wait for the writer
+        conn.execute('PRAGMA synchronous = NORMAL')  # safe with WAL, only a power loss may cost the last commits
+        conn.execute('PRAGMA temp_store = MEMORY')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        with self._lock:
+            if self._pid != os.getpid():  # a forked child mustn't touch its parent's connections
+                self._connections, self._pid = [], os.getpid()
+            self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        conn = self.connection()
+        if conn.in_transaction:  # part of a bigger one
+            yield conn
+            return
+        # takes the write lock right away, upgrading a read transaction later could deadlock with another writer
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                for conn in self._connections:
+                    conn.close()
+            self._connections, self._pid = [], None
+        self._local = threading.local()
+
+    def drop(self):
+        with self.transaction() as conn:
+            for table, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                       "AND sql LIKE 'CREATE VIRTUAL TABLE%'").fetchall():
+                conn.execute('DROP TABLE {}'.format(_quote(table)))
+            for name in COLLECTIONS + [INDEX_TABLE]:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(_quote(name)))
+            _create_tables(conn)
+        self._purged = {}
+
+    def indexes(self, conn: sqlite3.Connection, collection: str) -> dict:
+        """What the special indexes of a collection are, re-read whenever any process changed the schema."""
+        version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        if version != self._schema_version:
+            indexes = {}
+            for name, spec in conn.execute('SELECT collection, spec FROM {}'.format(INDEX_TABLE)):
+                spec = json.loads(spec)
+                found = indexes.setdefault(name, {'text': None, 'ttl': []})
+                if 'text' in spec:
+                    found['text'] = (spec['table'], spec['text'], spec['weights'])
+                if 'ttl' in spec:
+                    found['ttl'].append(tuple(spec['ttl']))
+            self._indexes, self._schema_version = indexes, version
+        return self._indexes.get(collection) or {'text': None, 'ttl': []}
+
+
+def _create_tables(conn: sqlite3.Connection):
+    for name in COLLECTIONS:
+        # no type on _id, it keeps whatever it's given like Mongo does: our snowflakes, strings, ...
+        conn.execute('CREATE TABLE IF NOT EXISTS {} (_id PRIMARY KEY, doc TEXT NOT NULL)'.format(_quote(name)))
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (collection TEXT NOT NULL, name TEXT NOT NULL, spec TEXT NOT NULL, '
+                 'PRIMARY KEY (collection, name))'.format(INDEX_TABLE))
+
+
+def _quote(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+# documents
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:  # Mongo takes naive datetimes as UTC as well
+            value = pytz.UTC.localize(value)
+        # and keeps milliseconds only
+        value = value.astimezone(pytz.UTC).replace(microsecond=value.microsecond // 1000 * 1000)
+        return DATE_MARK + value.strftime(DATE_FORMAT)
+    if isinstance(value, str):
+        return STRING_MARK + value if value.startswith('\x01') else value
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, str):
+        if value.startswith(DATE_MARK):
+            return datetime.datetime.strptime(value[2:], DATE_FORMAT).replace(tzinfo=pytz.UTC)
+        if value.startswith(STRING_MARK):
+            return value[2:]
+        return value
+    if isinstance(value, dict):
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _dumps(doc) -> str:
+    return json.dumps(doc, separators=(',', ':'), ensure_ascii=False)
+
+
+def _param(value):
+    """A query value the way json_extract() hands out the stored one."""
+    value = _encode(value)
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (dict, list)):
+        return _dumps(value)
+    return value
+
+
+def _path(field: str) -> str:
+    if not _FIELD.match(field):
+        raise NotImplementedError('Unsupported field name {!r}.'.format(field))
+    return '$.' + field
+
+
+def _field(field: str) -> str:
+    if field == '_id':
+        return '_id'
+    return "json_extract(doc, '{}')".format(_path(field))
+
+
+def _walk(doc: dict, field: str) -> typing.Tuple[dict, str]:
+    *parents, key = field.split('.')
+    for name in parents:
+        doc = doc.setdefault(name, {})
+    return doc, key
+
+
+def _apply(doc: dict, update: dict, inserting: bool = False) -> dict:
+    """Runs an update on an encoded document, in place."""
+    if not any(k.startswith('$') for k in update):  # a replacement
+        doc = {'_id': doc['_id']} if '_id' in doc else {}
+        doc.update(_encode({k: v for k, v in update.items() if k != '_id'}))
+        return doc
+    for op, fields in update.items():
+        for field, value in fields.items():
+            parent, key = _walk(doc, field)
+            value = _encode(value)
+            if op == '$set' or (op == '$setOnInsert' and inserting):
+                parent[key] = value
+            elif op == '$unset':
+                parent.pop(key, None)
+            elif op == '$inc':
+                parent[key] = parent.get(key, 0) + value
+            elif op == '$max':
+                if key not in parent or value > parent[key]:
+                    parent[key] = value
+            elif op == '$min':
+                if key not in parent or value < parent[key]:
+                    parent[key] = value
+            elif op != '$setOnInsert':
+                raise NotImplementedError('Unsupported update operator {}.'.format(op))
+    return doc
+
+
+def _upsert_doc(query: dict, update: dict) -> dict:
+    # equality conditions of the filter become fields of the new document, as in Mongo
+    doc = {k: _encode(v) for k, v in query.items()
+           if not k.startswith('$') and not (isinstance(v, dict) and any(x.startswith('$') for x in v))}
+    return _apply(doc, update, inserting=True)
+
+
+def _project(doc: dict, projection, score=None) -> dict:
+    if projection is None:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, True)
+    meta = [k for k, v in projection.items() if isinstance(v, dict)]
+    if any(v and k != '_id' and k not in meta for k, v in projection.items()):
+        out = {k: doc[k] for k, v in projection.items() if v and k in doc and k not in meta}
+        if projection.get('_id', True) and '_id' in doc:  # included unless excluded explicitly
+            out['_id'] = doc['_id']
+    else:
+        out = {k: v for k, v in doc.items() if projection.get(k, True)}
+    for k in meta:
+        out[k] = score
+    return out
+
+
+def _included(projection) -> typing.Optional[typing.List[str]]:
+    """The fields an inclusion projection asks for, so only those are read, None for all of them."""
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, True)
+    if not projection:
+        return None
+    fields = [k for k, v in projection.items() if v and k != '_id' and not isinstance(v, dict)]
+    return fields or ([] if projection.get('_id', True) else None)
+
+
+# queries
+
+def _where(query: dict) -> typing.Tuple[str, list]:
+    clauses, params = [], []
+    for key, cond in (query or {}).items():
+        if key == '$text':
+            continue  # joined in by the cursor
+        if key in ('$and', '$or'):
+            parts = [_where(sub) for sub in cond]
+            joiner = ' AND ' if key == '$and' else ' OR '
+            clauses.append('(' + joiner.join('(' + sql + ')' for sql, _ in parts) + ')')
+            params += [p for _, sub in parts for p in sub]
+        elif isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+            for op, value in cond.items():
+                sql, more = _condition(key, op, value)
+                clauses.append(sql)
+                params += more
+        else:
+            sql, more = _condition(key, '$eq', cond)
+            clauses.append(sql)
+            params += more
+    return ' AND '.join(clauses) or '1', params
+
+
+def _condition(field: str, op: str, value) -> typing.Tuple[str, list]:
+    expr = _field(field)
+    # a single value matches any element of a list field, which only json_each() can see
+    elements = field in ARRAY_FIELDS
+    if op == '$eq':
+        if value is None:
+            return '{} IS NULL'.format(expr), []
+        if elements and not isinstance(value, (list, tuple)):
+            return "EXISTS (SELECT 1 FROM json_each(doc, '{}') WHERE value = ?)".format(_path(field)), [_param(value)]
+        return '{} = ?'.format(expr), [_param(value)]
+    if op in ('$ne', '$nin'):
+        sql, params = _condition(field, '$eq' if op == '$ne' else '$in', value)
+        return 'NOT coalesce({}, 0)'.format(sql), params
+    if op == '$in':
+        values = list(value)
+        params = [_param(v) for v in values if v is not None]
+        parts = ['{} IS NULL'.format(expr)] if None in values else []
+        if params:
+            marks = ', '.join(['?'] * len(params))
+            if elements:
+                parts.append("EXISTS (SELECT 1 FROM json_each(doc, '{}') WHERE value IN ({}))".format(
+                    _path(field), marks))
+            else:
+                parts.append('{} IN ({})'.format(expr, marks))
+        return '(' + ' OR '.join(parts) + ')' if parts else '0', params
+    if op in ('$lt', '$lte', '$gt', '$gte'):
+        return '{} {} ?'.format(expr, {'$lt': '<', '$lte': '<=', '$gt': '>', '$gte': '>='}[op]), [_param(value)]
+    if op == '$exists':
+        if field == '_id':
+            return '1' if value else '0', []
+        return "json_type(doc, '{}') IS {}NULL".format(_path(field), 'NOT ' if value else ''), []
+    raise NotImplementedError('Unsupported query operator {}.'.format(op))
+
+
+def _order(sort) -> str:
+    parts = []
+    for field, direction in sort:
+        if isinstance(direction, dict):  # {'$meta': 'textScore'}, best first
+            parts.append('score DESC')
+        else:
+            parts.append('{} {}'.format(_field(field), 'DESC' if direction == pymongo.DESCENDING else 'ASC'))
+    return ', '.join(parts)
+
+
+def _fts_query(search: str) -> typing.Optional[str]:
+    """Translates Mongo's $search syntax: any of the words, all "quoted phrases", none of the -negated ones."""
+    words, phrases, excluded = [], [], []
+    for match in _SEARCH.finditer(search):
+        negated, phrase, word = match.groups()
+        text = phrase
+        if phrase is None:
+            negated, text = ('-', word[1:]) if word.startswith('-') else ('', word)
+        if not re.search(r'\w', text):
+            continue  # nothing FTS5 would index
+        quoted = '"{}"'.format(text.replace('"', '""'))
+        if negated:
+            excluded.append(quoted)
+        elif phrase is not None:
+            phrases.append(quoted)
+        else:
+            words.append(quoted)
+    positive = phrases + (['(' + ' OR '.join(words) + ')'] if words else [])
+    if not positive:
+        return None
+    return ' AND '.join(positive) + ''.join(' NOT ' + x for x in excluded)
+
+
+class Cursor:
+    """What find() returns, the query runs once it's iterated."""
+
+    def __init__(self, collection: 'SQLiteCollection', query: dict, projection=None):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort = []
+        self._limit = 0
+        self._skip = 0
+        self._batch_size = 100
+
+    def sort(self, key_or_list, direction=None) -> 'Cursor':
+        if isinstance(key_or_list, (list, tuple)):
+            self._sort = list(key_or_list)
+        else:
+            self._sort = [(key_or_list, direction or pymongo.ASCENDING)]
+        return self
+
+    def limit(self, limit: int) -> 'Cursor':
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int) -> 'Cursor':
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size: int) -> 'Cursor':
+        self._batch_size = batch_size or 100
+        return self
+
+    def _sql(self, conn: sqlite3.Connection) -> typing.Tuple[str, list, typing.Optional[typing.List[str]]]:
+        table = _quote(self._collection.name)
+        fields = _included(self._projection)
+        if fields is None:
+            columns = '_id, doc'
+        elif fields:
+            paths = ["'{}'".format(_path(field)) for field in fields]
+            # one path would return the bare value, two or more always give a JSON array
+            columns = '_id, json_extract(doc, {})'.format(', '.join(paths * (2 if len(paths) == 1 else 1)))
+        else:
+            columns = '_id, NULL'
+
+        where, params = _where(self._query)
+        join = ''
+        text = self._query.get('$text')
+        if text is not None:
+            index = self._collection.backend.indexes(conn, self._collection.name)['text']
+            if index is None:
+                raise pymongo.errors.OperationFailure('text index required for $text query', code=27)
+            fts, indexed, weights = index
+            search = _fts_query(text['$search'])
+            if search is None:
+                return 'SELECT {}, NULL FROM {} WHERE 0'.format(columns, table), [], fields
+            # bm25() is better the lower it is, Mongo's textScore the higher
+            rank = 'bm25({}, {})'.format(_quote(fts), ', '.join(str(weights.get(x, 1)) for x in indexed))
+            join = ' JOIN (SELECT rowid AS hit, -{} AS score FROM {} WHERE {} MATCH ?) ON hit = {}.rowid'.format(
+                rank, _quote(fts), _quote(fts), table)
+            params = [search] + params
+            columns += ', score'
+
+        sql = 'SELECT {} FROM {}{} WHERE {}'.format(columns, table, join, where)
+        if self._sort:
+            sql += ' ORDER BY ' + _order(self._sort)
+        if self._limit or self._skip:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [self._limit or -1, self._skip]
+        return sql, params, fields
+
+    def __iter__(self) -> typing.Iterator[dict]:
+        conn = self._collection.backend.connection()
+        sql, params, fields = self._sql(conn)
+        rows = conn.execute(sql, params)
+        while True:
+            batch = rows.fetchmany(self._batch_size)
+            if not batch:
+                return
+            for row in batch:
+                if fields is None:
+                    doc = json.loads(row[1])
+                elif fields:
+                    doc = dict(zip(fields, json.loads(row[1])))
+                else:
+                    doc = {}
+                doc = _decode(doc)
+                doc['_id'] = _decode(row[0])
+                yield _project(doc, self._projection, row[2] if len(row) > 2 else None)
+
+    def explain(self) -> dict:
+        """EXPLAIN QUERY PLAN, shaped like the parts of Mongo's explain() that migrations.winning_index() reads."""
+        conn = self._collection.backend.connection()
+        sql, params, _ = self._sql(conn)
+        plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        prefix = self._collection.name + '__'
+        for detail in plan:
+            match = re.search(r'USING (?:COVERING )?INDEX (\S+)', detail)
+            if match:
+                return {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN', 'indexName': match.group(1)[len(prefix):]
+                                                         if match.group(1).startswith(prefix) else match.group(1)},
+                                         'sqlite': plan}}
+            if 'PRIMARY KEY' in detail:
+                return {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN', 'indexName': '_id_'}, 'sqlite': plan}}
+        return {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}, 'sqlite': plan}}
+
+
+class SQLiteCollection:
+    def __init__(self, backend: SQLiteBackend, name: str):
+        self.backend = backend
+        self.name = name
+        self._table = _quote(name)
+
+    def __repr__(self):
+        return '<SQLiteCollection {} in {}>'.format(self.name, self.backend.path)
+
+    # reads
+
+    def find(self, filter: dict = None, projection=None) -> Cursor:
+        return Cursor(self, filter, projection)
+
+    def find_one(self, filter: dict = None, projection=None) -> typing.Optional[dict]:
+        for doc in self.find(filter, projection).limit(1):
+            return doc
+        return None
+
+    def count_documents(self, filter: dict) -> int:
+        where, params = _where(filter)
+        sql = 'SELECT COUNT(*) FROM {} WHERE {}'.format(self._table, where)
+        return self.backend.connection().execute(sql, params).fetchone()[0]
+
+    # writes, each one a transaction of its own unless it's part of bulk_write()
+
+    def insert_one(self, document: dict) -> pymongo.results.InsertOneResult:
+        with self.backend.transaction() as conn:
+            self._expire(conn)
+            return pymongo.results.InsertOneResult(self._insert(conn, document), True)
+
+    def insert_many(self, documents: typing.Iterable[dict], ordered: bool = True) -> pymongo.results.InsertManyResult:
+        inserted, errors = [], []
+        with self.backend.transaction() as conn:
+            self._expire(conn)
+            for index, document in enumerate(documents):
+                try:
+                    inserted.append(self._insert(conn, document))
+                except pymongo.errors.DuplicateKeyError as e:
+                    errors.append({'index': index, 'code': DUPLICATE_KEY, 'errmsg': str(e), 'op': document})
+                    if ordered:
+                        break
+        if errors:
+            raise pymongo.errors.BulkWriteError(_bulk_result(nInserted=len(inserted), writeErrors=errors))
+        return pymongo.results.InsertManyResult(inserted, True)
+
+    def update_one(self, filter: dict, update: dict, upsert: bool = False) -> pymongo.results.UpdateResult:
+        with self.backend.transaction() as conn:
+            self._expire(conn)
+            return pymongo.results.UpdateResult(self._update(conn, filter, update, upsert), True)
+
+    def update_many(self, filter: dict, update: dict, upsert: bool = False) -> pymongo.results.UpdateResult:
+        with self.backend.transaction() as conn:
+            self._expire(conn)
+            return pymongo.results.UpdateResult(self._update(conn, filter, update, upsert, multi=True), True)
+
+    def replace_one(self, filter: dict, replacement: dict, upsert: bool = False) -> pymongo.results.UpdateResult:
+        if any(k.startswith('$') for k in replacement):
+            raise ValueError('replacement can not include $ operators')
+        return self.update_one(filter, replacement, upsert)
+
+    def delete_one(self, filter: dict) -> pymongo.results.DeleteResult:
+        with self.backend.transaction() as conn:
+            return pymongo.results.DeleteResult({'n': self._delete(conn, filter, multi=False)}, True)
+
+    def delete_many(self, filter: dict) -> pymongo.results.DeleteResult:
+        with self.backend.transaction() as conn:
+            return pymongo.results.DeleteResult({'n': self._delete(conn, filter, multi=True)}, True)
+
+    def find_one_and_update(self, filter: dict, update: dict, projection=None, sort=None, upsert: bool = False,
+                            return_document=pymongo.ReturnDocument.BEFORE) -> typing.Optional[dict]:
+        with self.backend.transaction() as conn:
+            self._expire(conn)
+            found = self._rows(conn, filter, limit=1, sort=sort)
+            if found:
+                rowid, stored, key = found[0]
+                before = dict(json.loads(stored), **key)
+                after = _apply(dict(before), update)
+                self._write(conn, rowid, after)
+                doc = before if return_document == pymongo.ReturnDocument.BEFORE else after
+            elif upsert:
+                doc = _upsert_doc(filter, update)
+                self._insert_encoded(conn, doc)
+                if return_document == pymongo.ReturnDocument.BEFORE:
+                    return None
+            else:
+                return None
+        doc = _decode(doc)
+        return _project(doc, projection)
+
+    def bulk_write(self, requests: typing.Iterable, ordered: bool = True) -> pymongo.results.BulkWriteResult:
+        """Runs all operations in one transaction. Failed ones are reported the way MongoDB does."""
+        result = _bulk_result()
+        with self.backend.transaction() as conn:
+            self._expire(conn)
+            for index, op in enumerate(requests):
+                # pymongo's operation classes keep their arguments in these attributes
+                try:
+                    if isinstance(op, pymongo.InsertOne):
+                        self._insert(conn, op._doc)
+                        result['nInserted'] += 1
+                    elif isinstance(op, (pymongo.UpdateOne, pymongo.UpdateMany, pymongo.ReplaceOne)):
+                        raw = self._update(conn, op._filter, op._doc, op._upsert,
+                                           multi=isinstance(op, pymongo.UpdateMany))
+                        if 'upserted' in raw:
+                            result['nUpserted'] += 1
+                            result['upserted'].append({'index': index, '_id': raw['upserted']})
+                        else:
+                            result['nMatched'] += raw['n']
+                            result['nModified'] += raw['nModified']
+                    elif isinstance(op, (pymongo.DeleteOne, pymongo.DeleteMany)):
+                        result['nRemoved'] += self._delete(conn, op._filter, multi=isinstance(op, pymongo.DeleteMany))
+                    else:
+                        raise NotImplementedError('Unsupported bulk operation {!r}.'.format(op))
+                except pymongo.errors.DuplicateKeyError as e:
+                    result['writeErrors'].append({'index': index, 'code': DUPLICATE_KEY, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if result['writeErrors']:
+            raise pymongo.errors.BulkWriteError(result)
+        return pymongo.results.BulkWriteResult(result, True)
+
+    # indexes
+
+    def create_index(self, keys, unique: bool = False, name: str = None, weights: dict = None,
+                     expireAfterSeconds: int = None, **kwargs) -> str:
+        if kwargs:
+            raise NotImplementedError('Unsupported index options {}.'.format(', '.join(kwargs)))
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        name = name or '_'.join('{}_{}'.format(field, direction) for field, direction in keys)
+        text = [field for field, direction in keys if direction == pymongo.TEXT]
+
+        with self.backend.transaction() as conn:
+            spec = {}
+            if text:
+                fts = '{}__{}'.format(self.name, name)
+                existing = self.backend.indexes(conn, self.name)['text']
+                if existing is not None and existing[0] != fts:
+                    raise pymongo.errors.OperationFailure('only one text index per collection allowed', code=85)
+                if existing is None:
+                    # the porter stemmer, so "walking" finds "walked" like Mongo's language-aware stemming does
+                    conn.execute("CREATE VIRTUAL TABLE {} USING fts5({}, tokenize='porter unicode61')".format(
+                        _quote(fts), ', '.join(_quote(field) for field in text)))
+                    conn.execute('INSERT INTO {} (rowid, {}) SELECT rowid, {} FROM {}'.format(
+                        _quote(fts), ', '.join(_quote(field) for field in text),
+                        ', '.join(_field(field) for field in text), self._table))
+                spec.update(table=fts, text=text, weights=weights or {})
+            else:
+                # list fields stay out, an expression index can only hold one value per document
+                columns = ', '.join('{}{}'.format(_field(field), ' DESC' if direction == pymongo.DESCENDING else '')
+                                    for field, direction in keys if field not in ARRAY_FIELDS)
+                # which can leave it the same as one we have, e.g. (author_id, tags, _id) and (author_id, _id)
+                same = [sql for sql, in conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND "
+                                                     "tbl_name = ? AND sql IS NOT NULL", (self.name,))
+                        if sql.endswith('({})'.format(columns)) and sql.startswith('CREATE UNIQUE' if unique else '')]
+                if not same:
+                    conn.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                        'UNIQUE ' if unique else '', _quote('{}__{}'.format(self.name, name)), self._table, columns))
+            if expireAfterSeconds is not None:
+                spec['ttl'] = [keys[0][0], expireAfterSeconds]
+            if spec:
+                conn.execute('INSERT OR REPLACE INTO {} (collection, name, spec) VALUES (?, ?, ?)'.format(INDEX_TABLE),
+                             (self.name, name, _dumps(spec)))
+        return name
+
+    def drop_index(self, name: str):
+        qualified = '{}__{}'.format(self.name, name)
+        with self.backend.transaction() as conn:
+            found = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (qualified,)).fetchone()
+            if found is None:
+                raise pymongo.errors.OperationFailure('index not found with name [{}]'.format(name),
+                                                      code=INDEX_NOT_FOUND)
+            conn.execute('DROP {} {}'.format('INDEX' if found[0] == 'index' else 'TABLE', _quote(qualified)))
+            conn.execute('DELETE FROM {} WHERE collection = ? AND name = ?'.format(INDEX_TABLE), (self.name, name))
+
+    # internals, all within a transaction
+
+    def _rows(self, conn: sqlite3.Connection, query: dict, limit: int = None,
+              sort=None) -> typing.List[typing.Tuple[int, str, dict]]:
+        if '$text' in (query or {}):
+            raise NotImplementedError('$text is only supported by find().')
+        where, params = _where(query)
+        sql = 'SELECT rowid, _id, doc FROM {} WHERE {}'.format(self._table, where)
+        if sort:
+            sql += ' ORDER BY ' + _order(sort)
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        return [(rowid, doc, {'_id': _id}) for rowid, _id, doc in conn.execute(sql, params)]
+
+    def _duplicate(self, e: sqlite3.IntegrityError) -> pymongo.errors.DuplicateKeyError:
+        match = re.search(r"index '([^']+)'", str(e))
+        index = match.group(1).split('__', 1)[-1] if match else '_id_'
+        return pymongo.errors.DuplicateKeyError(
+            'E11000 duplicate key error collection: {} index: {}'.format(self.name, index), DUPLICATE_KEY)
+
+    def _insert(self, conn: sqlite3.Connection, document: dict):
+        if '_id' not in document:
+            document['_id'] = str(bson.ObjectId())  # pymongo also fills it in on the caller's document
+        return self._insert_encoded(conn, _encode(document))
+
+    def _insert_encoded(self, conn: sqlite3.Connection, doc: dict):
+        if '_id' not in doc:
+            doc['_id'] = str(bson.ObjectId())
+        body = {k: v for k, v in doc.items() if k != '_id'}
+        try:
+            cursor = conn.execute('INSERT INTO {} (_id, doc) VALUES (?, ?)'.format(self._table),
+                                  (doc['_id'], _dumps(body)))
+        except sqlite3.IntegrityError as e:
+            if 'UNIQUE' not in str(e):
+                raise
+            raise self._duplicate(e) from None
+        self._index_text(conn, cursor.lastrowid, body)
+        return _decode(doc['_id'])
+
+    def _write(self, conn: sqlite3.Connection, rowid: int, doc: dict):
+        body = {k: v for k, v in doc.items() if k != '_id'}
+        try:
+            conn.execute('UPDATE {} SET doc = ? WHERE rowid = ?'.format(self._table), (_dumps(body), rowid))
+        except sqlite3.IntegrityError as e:
+            if 'UNIQUE' not in str(e):
+                raise
+            raise self._duplicate(e) from None
+        self._index_text(conn, rowid, body, replace=True)
+
+    def _update(self, conn: sqlite3.Connection, query: dict, update: dict, upsert: bool, multi: bool = False) -> dict:
+        found = self._rows(conn, query, limit=None if multi else 1)
+        if not found:
+            if not upsert:
+                return {'n': 0, 'nModified': 0}
+            doc = _upsert_doc(query, update)
+            return {'n': 1, 'nModified': 0, 'upserted': self._insert_encoded(conn, doc)}
+
+        modified = 0
+        for rowid, stored, key in found:
+            doc = _apply(dict(json.loads(stored), **key), update)
+            doc.pop('_id', None)
+            if _dumps(doc) != stored:
+                self._write(conn, rowid, doc)
+                modified += 1
+        return {'n': len(found), 'nModified': modified}
+
+    def _delete(self, conn: sqlite3.Connection, query: dict, multi: bool) -> int:
+        where, params = _where(query)
+        sql = 'SELECT rowid FROM {} WHERE {}{}'.format(self._table, where, '' if multi else ' LIMIT 1')
+        rowids = [row[0] for row in conn.execute(sql, params)]
+        text = self.backend.indexes(conn, self.name)['text']
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            marks = ', '.join(['?'] * len(chunk))
+            conn.execute('DELETE FROM {} WHERE rowid IN ({})'.format(self._table, marks), chunk)
+            if text is not None:
+                conn.execute('DELETE FROM {} WHERE rowid IN ({})'.format(_quote(text[0]), marks), chunk)
+        return len(rowids)
+
+    def _index_text(self, conn: sqlite3.Connection, rowid: int, body: dict, replace: bool = False):
+        text = self.backend.indexes(conn, self.name)['text']
+        if text is None:
+            return
+        fts, fields, _ = text
+        if replace:
+            conn.execute('DELETE FROM {} WHERE rowid = ?'.format(_quote(fts)), (rowid,))
+        values = [_decode(body.get(field)) for field in fields]
+        conn.execute('INSERT INTO {} (rowid, {}) VALUES (?, {})'.format(
+            _quote(fts), ', '.join(_quote(field) for field in fields), ', '.join(['?'] * len(fields))),
+            [rowid] + [x if isinstance(x, str) else None for x in values])
+
+    def _expire(self, conn: sqlite3.Connection):
+        """Deletes documents past their TTL index' expiry every now and then, piggybacking on writes."""
+        ttl = self.backend.indexes(conn, self.name)['ttl']
+        if not ttl or time.monotonic() - self.backend._purged.get(self.name, 0) < TTL_INTERVAL:
+            return
+        self.backend._purged[self.name] = time.monotonic()
+        now = datetime.datetime.now(tz=pytz.UTC)
+        for field, seconds in ttl:
+            self._delete(conn, {field: {'$lt': now - datetime.timedelta(seconds=seconds)}}, multi=True)
+
+
+def _bulk_result(**values) -> dict:
+    result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+              'nModified': 0, 'nRemoved': 0, 'upserted': []}
+    result.update(values)
+    return result
@@ -1,29 +1,60 @@
 import time
 
 import datetime
+import html
 import jwt
+import os
 import pytz
+import random
+import re
+import typing
 from threading import RLock
 
+if typing.TYPE_CHECKING:
+    from journal.db.leases import WorkerLease
+
 EPOCH = datetime.datetime(2018, 1, 1, tzinfo=pytz.UTC).timestamp()
+MAX_ID = 2 ** 63 - 1  # MongoDB and SQLite both store signed 64 bit integers
 
 
 def id_to_time(_id):
     return datetime.datetime.fromtimestamp((_id >> 22) / 1000 + EPOCH, pytz.UTC)
 
 
+def time_to_id(when: datetime.datetime) -> int:
+    """The lowest ID that could've been generated at the given time."""
+    return max(int((when.timestamp() - EPOCH) * 1000), 0) << 22
+
+
 class IDGenerator:
-    def __init__(self, worker_id=0):
+    """Mints snowflake IDs, unique as long as no two processes use the same worker ID at the same time.
+
+    Layout, from the top: 42 bits of milliseconds since EPOCH, 10 bits of worker ID, a 12 bit counter.
+    Pass a WorkerLease instead of a fixed worker ID to have each process lease its own.
+    """
+
+    def __init__(self, worker_id=0, lease: 'WorkerLease' = None):
         self._worker_id = None
         self._last_gen_ms = 0
-        self._last_gen_c = 0
         self._lock = RLock()
+        self._lease = lease
+        self._lease_pid = None
 
         self.counter = 0
-        self.worker_id = worker_id
+        if lease is None:
+            self.worker_id = worker_id
 
     @property
     def worker_id(self) -> int:
+        if self._lease is not None and self._lease_pid != os.getpid():
+            with self._lock:
+                if self._lease_pid != os.getpid():
+                    self.worker_id, floor = self._lease.acquire(self)
+                    # the previous holder of this worker ID may have run ahead of our clock, we start on the
+                    # millisecond after its last one
+                    if floor >= self._last_gen_ms:
+                        self._last_gen_ms, self.counter = floor + 1, -1
+                    self._lease_pid = os.getpid()
         return self._worker_id
 
     @worker_id.setter
@@ -32,29 +63,87 @@ class IDGenerator:
             raise ValueError('Worker ID must be between 0 and 1023 (inclusive).')
         self._worker_id = _id
 
-    def generate(self):
-        self._lock.acquire()
-
+    @property
+    def last_ms(self) -> int:
+        """The millisecond of the newest ID handed out, a successor with our worker ID has to start after it."""
+        return self._last_gen_ms
+
+    def release_worker_id(self):
+        """Leases a new worker ID before the next ID is generated."""
+        with self._lock:
+            self._lease_pid = None
+
+    def generate(self) -> int:
+        with self._lock:
+            return self._next(self.worker_id)
+
+    def generate_many(self, n: int) -> typing.List[int]:
+        """n IDs in one go, for bulk writes."""
+        with self._lock:
+            worker_id = self.worker_id
+            return [self._next(worker_id) for _ in range(n)]
+
+    def generate_at(self, when: datetime.datetime) -> int:
+        """An ID dated ``when`` instead of now, for things from the past that have to sort where they belong.
+
+        The counter is random since that millisecond is long gone, so it might still be taken: insert these
+        expecting a duplicate key error now and then.
+        """
+        return time_to_id(when) | self.worker_id << 12 | random.getrandbits(12)
+
+    def _next(self, worker_id: int) -> int:
+        # we never go back in time: if the clock steps backwards we keep counting on the last millisecond
+        # used, and borrow the next one when that runs out, until the clock catches up again
+        # the counter restarts every millisecond, which keeps each process' IDs strictly increasing
+        now_ms = max(int((time.time() - EPOCH) * 1000), self._last_gen_ms)
+        if now_ms > self._last_gen_ms:
+            self.counter = 0
+        elif self.counter < 4095:
+            self.counter += 1
+        else:  # all 4096 IDs of this millisecond are used up
+            now_ms = self._wait_past(now_ms)
+            self.counter = 0
+        self._last_gen_ms = now_ms
+
+        return now_ms << 22 | worker_id << 12 | self.counter
+
+    @staticmethod
+    def _wait_past(ms: int) -> int:
         now_ms = int((time.time() - EPOCH) * 1000)
-        if self._last_gen_ms < now_ms:
-            self._last_gen_ms = now_ms
-            self._last_gen_c = self.counter
-        elif self._last_gen_ms > now_ms:
-            raise RuntimeError('Time ran backwards!')
-
-        next_iteration = (self.counter + 1) % 4096
-        if now_ms == self._last_gen_ms and next_iteration == self._last_gen_c:
-            raise RuntimeError('4095 IDs generated in one millisecond?!')
-
-        self.counter = next_iteration
-
-        self._lock.release()
-
-        # 64 - 22: time
-        # 22 - 12: worker ID
-        # 12 - 0: counter
-
-        return now_ms << 22 | self.worker_id << 10 | self.counter
+        if now_ms < ms - 1:  # clock is behind, waiting could take forever
+            return ms + 1
+        while now_ms <= ms:
+            time.sleep(0.0001)
+            now_ms = int((time.time() - EPOCH) * 1000)
+        return now_ms
+
+
+def search_terms(query: str) -> typing.List[str]:
+    """The words of a $text query worth highlighting, i.e. without negations and operators."""
+    return [word for word in re.findall(r'-?\w+', query) if not word.startswith('-')]
+
+
+def highlight(text: str, terms: typing.List[str], width: int = 200) -> str:
+    """Returns an HTML-escaped excerpt of text around the first match, with matches wrapped in <mark>."""
+    if not terms:
+        return html.escape(text[:width])
+    # Mongo stems words, so "walking" should also light up for "walk"
+    pattern = re.compile(r'\b(?:{})\w*'.format('|'.join(re.escape(t) for t in terms)), re.IGNORECASE)
+
+    first = pattern.search(text)
+    start = max(0, (first.start() if first else 0) - width // 4)
+    excerpt = text[start:start + width]
+
+    out = ['&hellip;' if start else '']
+    last = 0
+    for match in pattern.finditer(excerpt):
+        out.append(html.escape(excerpt[last:match.start()]))
+        out.append('<mark>{}</mark>'.format(html.escape(match.group())))
+        last = match.end()
+    out.append(html.escape(excerpt[last:]))
+    if start + width < len(text):
+        out.append('&hellip;')
+    return ''.join(out)
 
 
 class JWTEncoder:
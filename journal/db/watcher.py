@@ -0,0 +1,89 @@
+import time
+
+import collections
+import logging
+import os
+import pymongo.errors
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from journal.db import DatabaseInterface
+    from journal.db.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+# "The $changeStream stage is only supported on replica sets", i.e. a standalone mongod
+UNSUPPORTED_CODES = {40573, 40324}
+
+
+class ChangeWatcher:
+    """Tails a change stream and evicts changed documents from registered local caches.
+
+    Caches must be keyed by document ID. Without change streams, or while the stream is down,
+    they simply fall back to their own TTLs.
+    """
+
+    def __init__(self, db: 'DatabaseInterface', retry_delay: float = 5, max_retry_delay: float = 300):
+        self.db = db
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.available = True
+        self._caches = collections.defaultdict(list)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, collection: str, cache: 'LRUCache'):
+        self._caches[collection].append(cache)
+
+    def ensure_running(self):
+        """Starts the watcher thread for this process, cheap enough to call on every request."""
+        if not self.available or (self._pid == os.getpid() and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            # threads don't survive a fork, so every worker needs its own
+            self._thread = threading.Thread(target=self._run, name='journal-change-watcher', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _clear(self):
+        for caches in self._caches.values():
+            for cache in caches:
+                cache.clear()
+
+    def dispatch(self, change: dict):
+        if change['operationType'] in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+            self._clear()
+            return
+        for cache in self._caches.get(change['ns']['coll'], []):
+            cache.pop(change['documentKey']['_id'])
+
+    def _run(self):
+        pipeline = [{'$match': {'ns.coll': {'$in': list(self._caches)}}}]
+        resume_token = None
+        delay = self.retry_delay
+        while True:
+            try:
+                with self.db.db.watch(pipeline, resume_after=resume_token) as stream:
+                    delay = self.retry_delay  # it's up again
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self.dispatch(change)
+            except pymongo.errors.OperationFailure as e:
+                if e.code in UNSUPPORTED_CODES:
+                    log.info('Change streams unavailable, caches will rely on their TTLs.')
+                    self.available = False
+                    return
+                log.warning('Change stream failed, restarting without resume token in %.0fs: %s', delay, e)
+                resume_token = None
+                self._clear()  # we may have missed events in between
+            except pymongo.errors.PyMongoError as e:
+                log.warning('Change stream interrupted, retrying in %.0fs: %s', delay, e)
+            else:
+                continue  # the stream ended (invalidated), reopen right away
+            # errors that don't go away (bad credentials, say) would have us hammer the server otherwise
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
@@ -0,0 +1,143 @@
+"""Runs a WSGI app under an ASGI server, on a thread pool of its own.
+
+asgiref's WsgiToAsgi would do, but it runs every request on one shared thread, which serializes the whole
+Flask app behind a single slow request.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import sys
+import tempfile
+import typing
+
+log = logging.getLogger(__name__)
+
+SPOOL_BYTES = 1024 * 1024  # request bodies larger than this are buffered on disk
+QUEUE_CHUNKS = 8  # response chunks a worker thread may produce ahead of the client
+_END = object()
+
+
+class WSGIBridge:
+    def __init__(self, app: typing.Callable, threads: int = 32):
+        self.app = app
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='journal-wsgi')
+
+    async def __call__(self, scope: dict, receive: typing.Callable, send: typing.Callable):
+        body = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        length = body.tell()
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(QUEUE_CHUNKS)
+        started = {}
+
+        def put(item):
+            # blocks the worker thread while the queue is full, so slow clients don't make us buffer everything
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'], started['headers'] = status, headers
+
+        def run():
+            # the whole response is produced in one thread, Flask's streamed responses rely on their context
+            try:
+                result = self.app(_environ(scope, body, length), start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                put(_END)
+            except BaseException as e:
+                put(e)
+            finally:
+                body.close()
+
+        worker = loop.run_in_executor(self.pool, run)
+        try:
+            await self._forward(chunks, started, send)
+        finally:
+            # keep taking chunks until the thread is done, it would wait for queue space forever otherwise
+            while not started.get('done'):
+                item = await chunks.get()
+                started['done'] = item is _END or isinstance(item, BaseException)
+            await worker
+
+    @staticmethod
+    async def _forward(chunks: asyncio.Queue, started: dict, send: typing.Callable):
+        item = await chunks.get()
+        started['done'] = item is _END or isinstance(item, BaseException)
+        if isinstance(item, BaseException):
+            log.error('Unhandled exception in WSGI app', exc_info=item)
+            await send({'type': 'http.response.start', 'status': 500,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+            return
+
+        started['sent'] = True
+        await send({
+            'type': 'http.response.start', 'status': int(started['status'].split(' ', 1)[0]),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in started['headers']],
+        })
+        while item is not _END:
+            if isinstance(item, BaseException):  # headers are out already, all we can do is cut it short
+                log.error('Unhandled exception in WSGI app while streaming', exc_info=item)
+                break
+            await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+            item = await chunks.get()
+            started['done'] = item is _END or isinstance(item, BaseException)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+def _environ(scope: dict, body, length: int) -> dict:
+    root = scope.get('root_path', '')
+    path = scope['path'][len(root):] if scope['path'].startswith(root) else scope['path']
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # PEP 3333 wants these as latin-1 decoded bytes
+        'SCRIPT_NAME': root.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    # the body is all here already, chunked or not, and Werkzeug reads nothing without a length
+    environ['CONTENT_LENGTH'] = str(length)
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+    return environ
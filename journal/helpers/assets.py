@@ -0,0 +1,80 @@
+import functools
+import gzip
+import hashlib
+import os
+import ujson
+
+try:
+    import brotli
+except ImportError:  # optional, without it only .gz variants are built
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'modules', 'web', 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = os.path.join(DIST_DIR, 'manifest.json')
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+# hashed files never change, so browsers may keep them for as long as they like
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def build(static_dir: str = STATIC_DIR, dist_dir: str = DIST_DIR) -> dict:
+    """Copies every static file to ``dist_dir`` under a name containing its content hash.
+
+    Text assets also get .gz (and .br, with brotli installed) siblings so they can be served precompressed.
+    Writes and returns the manifest mapping original paths to hashed ones.
+    """
+    manifest = {}
+    for path, dirs, files in os.walk(static_dir):
+        if os.path.abspath(path).startswith(os.path.abspath(dist_dir)):
+            continue
+        for name in files:
+            source = os.path.join(path, name)
+            relative = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            stem, ext = os.path.splitext(relative)
+            hashed = '{}.{}{}'.format(stem, hashlib.blake2b(data, digest_size=6).hexdigest(), ext)
+            target = os.path.join(dist_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write(target, data)
+            if ext in COMPRESSIBLE:
+                _write(target + '.gz', gzip.compress(data, 9, mtime=0))
+                if brotli is not None:
+                    _write(target + '.br', brotli.compress(data, quality=11))
+            manifest[relative] = hashed
+
+    os.makedirs(dist_dir, exist_ok=True)
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as f:
+        ujson.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _write(path, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@functools.lru_cache(maxsize=None)
+def manifest() -> dict:
+    try:
+        with open(MANIFEST) as f:
+            return ujson.load(f)
+    except FileNotFoundError:  # assets weren't built, e.g. in development
+        return {}
+
+
+def url(path: str) -> str:
+    """The URL to link a static asset by, fingerprinted if the assets were built."""
+    hashed = manifest().get(path)
+    if hashed is None:
+        return '/static/' + path
+    return '/static/dist/' + hashed
+
+
+def variant(filename: str, accept_encoding) -> tuple:
+    """Picks the best precompressed file for a request, returns (filename, content encoding or None)."""
+    for encoding, suffix in [('br', '.br'), ('gzip', '.gz')]:
+        if encoding in accept_encoding and os.path.isfile(os.path.join(DIST_DIR, filename + suffix)):
+            return filename + suffix, encoding
+    return filename, None
@@ -0,0 +1,52 @@
+import datetime
+import gzip
+import typing
+import ujson
+import zlib
+from flask import Response
+
+CHUNK_SIZE = 64 * 1024
+
+
+def export_lines(user) -> typing.Iterator[bytes]:
+    """One JSON document per entry and line, bundled into chunks of about CHUNK_SIZE bytes."""
+    chunk, size = [], 0
+    for entry in user.export():
+        line = (ujson.dumps(entry.to_json()) + '\n').encode()
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def gzipped(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # 31 makes zlib write a gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(user, compress: bool = False) -> Response:
+    """Streams a backup of the user's journal, the entries never are all in memory at once."""
+    name = 'journal-{}-{}.ndjson'.format(user.username, datetime.date.today().isoformat())
+    body, mimetype = export_lines(user), 'application/x-ndjson'
+    if compress:
+        body, mimetype, name = gzipped(body), 'application/gzip', name + '.gz'
+
+    resp = Response(body, mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(name)
+    return resp
+
+
+def import_lines(stream, compressed: bool = False) -> typing.Iterator[typing.Tuple[int, bytes]]:
+    """Yields the non-empty lines of an uploaded backup with their line numbers, decompressing as it goes."""
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            yield number, line
@@ -0,0 +1,73 @@
+import functools
+import hashlib
+import os
+from flask import Response, request
+
+from journal.helpers import assets
+
+TEMPLATE_DIRS = [os.path.join(os.path.dirname(os.path.dirname(__file__)), 'modules', 'web', 'templates')]
+
+
+@functools.lru_cache(maxsize=None)
+def template_version() -> str:
+    """Changes whenever a deploy changes the templates or assets, so pages rendered by older code aren't reused."""
+    digest = hashlib.blake2b(repr(sorted(assets.manifest().items())).encode(), digest_size=8)
+    for base in TEMPLATE_DIRS:
+        for path, dirs, files in sorted(os.walk(base)):
+            dirs.sort()
+            for name in sorted(files):
+                with open(os.path.join(path, name), 'rb') as f:
+                    digest.update(name.encode() + f.read())
+    return digest.hexdigest()
+
+
+def etag(*parts) -> str:
+    """A strong ETag over everything the response depends on."""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def entry_etag(entry, *parts) -> str:
+    return entry_tag(entry.id, entry.updated, *parts)
+
+
+def entry_tag(entry_id: int, updated: int, *parts) -> str:
+    # `updated` is a fresh snowflake on every write, so it's all we need to know about the entry itself
+    return etag('entry', entry_id, updated, *parts)
+
+
+def listing_etag(user, *parts) -> str:
+    return listing_tag(user.id, user.listing_version(), request.path, request.query_string, *parts)
+
+
+def listing_tag(user_id: int, version: int, path: str, query_string: bytes, *parts) -> str:
+    # the async API computes these without a Flask request, they must match for clients switching between both
+    return etag('listing', user_id, version, path, query_string, *parts)
+
+
+def page_etag(user, *parts) -> str:
+    """For rendered pages, which also depend on the user's settings and the templates."""
+    return etag(template_version(), user.id, user.display_name, user.ui_theme, user.ui_font_title,
+                user.ui_font_body, sorted(user.flags), *parts)
+
+
+def is_fresh(tag: str) -> bool:
+    return tag in request.if_none_match
+
+
+def set_headers(resp: Response, tag: str) -> Response:
+    resp.set_etag(tag)
+    # only the user's own browser may keep it, and only after asking us whether it's still current
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def not_modified(tag: str) -> Response:
+    return set_headers(Response(status=304), tag)
+
+
+def cached(body, tag: str) -> Response:
+    """Turns a rendered page into a response that can be revalidated with If-None-Match."""
+    if is_fresh(tag):
+        return not_modified(tag)
+    return set_headers(Response(body, mimetype='text/html'), tag)
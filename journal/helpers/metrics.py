@@ -0,0 +1,181 @@
+"""Opt-in request instrumentation: route latencies, MongoDB commands and named spans around hot helpers.
+
+Everything here is a cheap no-op until ``init_app()`` enabled it, so the database layer can wrap its hot
+paths in ``span()`` unconditionally.
+"""
+import bisect
+import collections
+import contextlib
+import hmac
+import threading
+import time
+import typing
+from flask import Flask, abort, g, request, template_rendered, before_render_template
+from pymongo import monitoring
+
+# seconds, roughly what Prometheus' client libraries use
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """An upper bound for the q-quantile, as precise as the buckets allow."""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # (family, labels) -> Histogram, families being 'request', 'mongo' and 'span'
+        self.histograms = collections.defaultdict(Histogram)
+        self.errors = collections.Counter()
+
+    def observe(self, family: str, labels: typing.Tuple[typing.Tuple[str, str], ...], seconds: float):
+        with self._lock:
+            self.histograms[family, labels].observe(seconds)
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None and family != 'request':  # Server-Timing has all commands together as 'mongo'
+            timings['mongo' if family == 'mongo' else labels[0][1]] += seconds
+
+    def error(self, family: str, labels: typing.Tuple[typing.Tuple[str, str], ...]):
+        with self._lock:
+            self.errors[family, labels] += 1
+
+    def start_request(self):
+        self._local.timings = collections.defaultdict(float)
+
+    def end_request(self) -> typing.Dict[str, float]:
+        timings, self._local.timings = getattr(self._local, 'timings', None) or {}, None
+        return timings
+
+    def snapshot(self) -> typing.List[typing.Tuple[str, dict, Histogram, int]]:
+        with self._lock:
+            return [(family, dict(labels), _copy(hist), self.errors[family, labels])
+                    for (family, labels), hist in sorted(self.histograms.items())]
+
+    def prometheus(self) -> str:
+        lines = []
+        families = {'request': 'journal_request_duration_seconds', 'mongo': 'journal_mongo_command_duration_seconds',
+                    'span': 'journal_span_duration_seconds'}
+        for family, name in families.items():
+            lines.append('# TYPE {} histogram'.format(name))
+            for _, labels, hist, _ in (x for x in self.snapshot() if x[0] == family):
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels, le=bound), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), hist.sum))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), hist.count))
+        lines.append('# TYPE journal_mongo_command_failures_total counter')
+        for family, labels, _, errors in self.snapshot():
+            if family == 'mongo' and errors:
+                lines.append('journal_mongo_command_failures_total{} {}'.format(_labels(labels), errors))
+        return '\n'.join(lines) + '\n'
+
+
+def _copy(hist: Histogram) -> Histogram:
+    new = Histogram()
+    new.counts, new.count, new.sum = list(hist.counts), hist.count, hist.sum
+    return new
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = dict(labels, **{k: str(v) for k, v in extra.items()})
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+registry = Registry()
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Times the block as a named span, if instrumentation is on."""
+    if not registry.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('span', (('span', name),), time.perf_counter() - start)
+
+
+class CommandListener(monitoring.CommandListener):
+    """Counts and times every command pymongo sends, pass it in ``event_listeners``."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if registry.enabled:
+            registry.observe('mongo', (('command', event.command_name),), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        if registry.enabled:
+            labels = (('command', event.command_name),)
+            registry.observe('mongo', labels, event.duration_micros / 1e6)
+            registry.error('mongo', labels)
+
+
+def init_app(app: Flask, server_timing: bool = False, token: str = None):
+    """Turns instrumentation on for this process and adds the /metrics endpoint."""
+    registry.enabled = True
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        registry.start_request()
+
+    @app.after_request
+    def record(resp):
+        start = g.pop('metrics_start', None)
+        timings = registry.end_request()
+        if start is None:
+            return resp
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.observe('request', (('route', route), ('method', request.method),
+                                     ('status', str(resp.status_code))), elapsed)
+        if server_timing:  # for local debugging, it tells anyone where our time goes
+            parts = ['{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in sorted(timings.items())]
+            resp.headers['Server-Timing'] = ', '.join(parts + ['total;dur={:.2f}'.format(elapsed * 1000)])
+        return resp
+
+    def template_start(sender, template, context, **extra):
+        g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+    def template_end(sender, template, context, **extra):
+        starts = g.get('metrics_templates')
+        if starts:
+            registry.observe('span', (('span', 'template'),), time.perf_counter() - starts.pop())
+
+    before_render_template.connect(template_start, app, weak=False)
+    template_rendered.connect(template_end, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        if not token:  # nobody to show them to, /app/admin still has them
+            return abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            return abort(401)
+        return registry.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -0,0 +1,119 @@
+import time
+
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+from flask import current_app, request
+from flask_limiter import Limiter
+from limits.storage import Storage
+
+DEFAULT_STORAGE_URI = 'journal+sqlite:///' + os.path.join(tempfile.gettempdir(), 'journal-ratelimit.sqlite')
+DEFAULT_LIMITS = {
+    'login': '30/minute',  # per client address
+    'login_user': '10/minute',  # per username being logged into
+    'new_entry': '60/minute',  # per client address
+    'new_entry_user': '30/minute',  # per logged in user
+    'export': '5/minute',  # per logged in user
+    'bulk_write': '10/minute',  # per logged in user, each request carries up to MAX_BULK_OPERATIONS writes
+}
+SWEEP_CHANCE = 0.01  # share of increments that also drop every expired counter, not just their own
+
+
+class SQLiteStorage(Storage):
+    """Fixed-window counters in a local SQLite file, shared by every worker on the host.
+
+    Selected with ``journal+sqlite:///path/to/file.sqlite``, e.g. somewhere on a tmpfs.
+    """
+
+    STORAGE_SCHEME = ['journal+sqlite']
+
+    def __init__(self, uri: str = None, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = uri.split('://', 1)[1] or DEFAULT_STORAGE_URI.split('://', 1)[1]
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER, expires REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS counters_expires ON counters (expires)')
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't cross threads or forks
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn.execute('PRAGMA journal_mode=WAL')
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if random.random() < SWEEP_CHANCE:
+                # keys of clients that never came back would pile up otherwise
+                conn.execute('DELETE FROM counters WHERE expires <= ?', (now,))
+            else:
+                conn.execute('DELETE FROM counters WHERE key = ? AND expires <= ?', (key, now))
+            conn.execute('INSERT INTO counters (key, value, expires) VALUES (?, ?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET value = value + excluded.value',
+                         (key, amount, now + expiry))
+            if elastic_expiry:
+                conn.execute('UPDATE counters SET expires = ? WHERE key = ?', (now + expiry, key))
+            value, = conn.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return value
+
+    def get(self, key: str) -> int:
+        row = self._connection().execute('SELECT value FROM counters WHERE key = ? AND expires > ?',
+                                         (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        row = self._connection().execute('SELECT expires FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self) -> bool:
+        try:
+            self._connection().execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int:
+        return self._connection().execute('DELETE FROM counters').rowcount
+
+    def clear(self, key: str):
+        self._connection().execute('DELETE FROM counters WHERE key = ?', (key,))
+
+
+def client_address() -> str:
+    # behind proxies this comes from X-Forwarded-For, see proxy_count in README
+    return request.remote_addr or '127.0.0.1'
+
+
+def login_username() -> str:
+    data = request.form or request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    return 'username:{}'.format(str(data.get('username') or '').strip().lower())
+
+
+def current_user() -> str:
+    user = getattr(request, 'user', None)
+    return 'user:{}'.format(user.id if user else client_address())
+
+
+def configured(name: str):
+    """Looks the limit up at request time, so config.yml can change it per app."""
+    return lambda: current_app.ratelimits[name]
+
+
+limiter = Limiter(key_func=client_address)
@@ -1,8 +1,79 @@
+import concurrent.futures
+import os
 import requests
+import requests.adapters
+import threading
 from flask import current_app as app
 
+from journal.db.cache import LRUCache
 
-session = requests.Session()
+DEFAULT_VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
+
+
+class Verifier:
+    """Checks reCAPTCHA responses against a verification endpoint with bounded time and connections.
+
+    Results are cached per response token for ``cache_ttl`` seconds, tokens being single-use on Google's end
+    anyway. If the endpoint can't be reached in time, ``fail_open`` decides whether the user is let through.
+    """
+
+    def __init__(self, secret: str, site: str, *, verify_url: str = DEFAULT_VERIFY_URL,
+                 connect_timeout: float = 2, read_timeout: float = 5, fail_open: bool = False,
+                 pool_size: int = 8, cache_ttl: float = 120):
+        self.secret = secret
+        self.site = site
+        self.verify_url = verify_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.fail_open = fail_open
+        self.pool_size = pool_size
+        self.cache = LRUCache(4096, cache_ttl)
+        self._session = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_pool(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # neither sockets nor threads should be shared with a parent process
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.pool_size, thread_name_prefix='recaptcha')
+            self._pid = os.getpid()
+
+    def verify(self, response: str) -> bool:
+        if not response:
+            return False
+
+        cached = self.cache.get(response)
+        if cached is not None:
+            return cached
+
+        self._ensure_pool()
+        try:
+            success = self._session.post(
+                self.verify_url,
+                data={
+                    'secret': self.secret,
+                    'response': response,
+                },
+                timeout=self.timeout,
+            ).json()['success'] is True
+        except (requests.RequestException, ValueError, KeyError):
+            return self.fail_open  # not cached, the next attempt might get through
+
+        self.cache.put(response, success)
+        return success
+
+    def submit(self, response: str) -> concurrent.futures.Future:
+        """Starts verification in the background, so the caller can do other work in the meantime."""
+        self._ensure_pool()
+        return self._executor.submit(self.verify, response)
 
 
 def is_enabled() -> bool:
@@ -12,27 +83,18 @@ def is_enabled() -> bool:
 def get_site_key() -> str:
     if not is_enabled():
         return ''
-    return app.recaptcha['site']
+    return app.recaptcha.site
 
 
-def _get_secret() -> str:
-    return app.recaptcha['secret']
+def validate_async(response: str) -> concurrent.futures.Future:
+    if not is_enabled():
+        future = concurrent.futures.Future()
+        future.set_result(True)
+        return future
+    return app.recaptcha.submit(response)
 
 
 def validate(response: str) -> bool:
     if not is_enabled():
         return True
-
-    success = False
-    if not response:
-        return success
-
-    success = session.post(
-        'https://www.google.com/recaptcha/api/siteverify',
-        data={
-            'secret': _get_secret(),
-            'response': response,
-        }
-    ).json()['success']
-
-    return success
+    return app.recaptcha.verify(response)
@@ -1,14 +1,23 @@
+import datetime
 import typing
 import functools
+import pytz
 import ujson
 
 from flask import Blueprint, Response, current_app, abort, request
 from werkzeug.exceptions import HTTPException
 
-from journal.helpers import recaptcha
+from journal.db import ConflictError
+from journal.db.hashing import Overloaded
+from journal.db.util import MAX_ID, id_to_time
+from journal.helpers import backup, caching, recaptcha, ratelimit
+from journal.helpers.ratelimit import limiter
 
 
 bp = Blueprint(name='api', import_name=__name__, url_prefix='/api')
+ENTRY_FIELDS = {'title': str, 'content': str, 'tags': list}
+MAX_BULK_OPERATIONS = 1000
+MAX_IMPORT_ERRORS = 100
 
 
 class UserException(Exception):
@@ -16,7 +25,8 @@ class UserException(Exception):
         super().__init__(msg)
 
 
-def verify_fields(data, check: typing.Dict[str, typing.Any], *ignore: str) -> dict:
+def verify_fields(data, check: typing.Dict[str, typing.Any], *ignore: str,
+                  optional: typing.Dict[str, typing.Any] = None) -> dict:
     verified = {}
 
     if not isinstance(data, dict):
@@ -25,7 +35,10 @@ def verify_fields(data, check: typing.Dict[str, typing.Any], *ignore: str) -> di
     for k, v in check.items():
         if k not in data:
             raise UserException('Required field "{}" missing.'.format(k))
-        if not isinstance(data[k], v):
+    for k, v in dict(optional or {}, **check).items():
+        if k not in data:
+            continue
+        if not isinstance(data[k], v) or (v is int and isinstance(data[k], bool)):
             raise UserException('Field "{}" was of type "{}", "{}" expected.'
                                 .format(k, type(data[k]).__name__, v.__name__))
         verified[k] = data[k]
@@ -37,7 +50,65 @@ def verify_fields(data, check: typing.Dict[str, typing.Any], *ignore: str) -> di
     return verified
 
 
-def respond(data: typing.Optional[typing.Union[dict, list]] = None, *, status: int = 200):
+def verify_entry_fields(data, check: typing.Dict[str, typing.Any], optional: typing.Dict[str, typing.Any]) -> dict:
+    verified = verify_fields(data, check, optional=dict(ENTRY_FIELDS, **optional))
+    if not all(isinstance(x, str) for x in verified.get('tags', [])):
+        raise UserException('Field "tags" has to be a list of strings.')
+    return verified
+
+
+def verify_operation(data) -> dict:
+    op = verify_fields(data, {'op': str}).get('op')
+    if op == 'create':
+        return dict(verify_entry_fields(data, {}, {}), op=op)
+    if op == 'update':
+        return dict(verify_entry_fields(data, {'id': int}, {'revision': int}), op=op)
+    if op == 'delete':
+        return dict(verify_fields(data, {'id': int}), op=op)
+    raise UserException('Operation "{}" unknown, expected "create", "update" or "delete".'.format(op))
+
+
+def verify_backup_line(line: bytes) -> dict:
+    try:
+        data = ujson.loads(line)
+    except ValueError:
+        raise UserException('Line is not valid JSON.')
+    data = verify_entry_fields(data, {}, {'_id': int, 'timestamp': str, 'timezone': str})
+
+    # IDs and timestamps have to fit a snowflake and not be from the future (a day of slack for clocks and
+    # time zones), or they'd overflow on insert or stick to the top of every listing
+    latest = datetime.datetime.now(tz=pytz.UTC) + datetime.timedelta(days=1)
+    if '_id' in data and not (0 < data['_id'] <= MAX_ID and id_to_time(data['_id']) <= latest):
+        raise UserException('Field "_id" is out of range.')
+    if 'timezone' in data and data['timezone'] not in pytz.all_timezones_set:
+        raise UserException('Timezone "{}" unknown.'.format(data['timezone']))
+    if 'timestamp' in data:
+        try:
+            data['timestamp'] = datetime.datetime.fromisoformat(data['timestamp'])
+        except ValueError:
+            raise UserException('Field "timestamp" is not an ISO 8601 date.')
+        if data['timestamp'].tzinfo is None:
+            data['timestamp'] = pytz.UTC.localize(data['timestamp'])
+        # dates near year 1 overflow once moved to their time zone
+        if not datetime.datetime(1900, 1, 1, tzinfo=pytz.UTC) <= data['timestamp'] <= latest:
+            raise UserException('Field "timestamp" is out of range.')
+    return data
+
+
+def parse_id(id) -> int:
+    try:
+        id = int(id)
+        if not 0 <= id <= MAX_ID:
+            raise ValueError()
+    except ValueError:
+        raise UserException('ID given is not an integer.')
+    return id
+
+
+def respond(data: typing.Optional[typing.Union[dict, list]] = None, *, status: int = 200, etag: str = None):
+    if etag and caching.is_fresh(etag):
+        return caching.not_modified(etag)
+
     resp = Response()
     if not data:
         status = 204
@@ -47,7 +118,9 @@ def respond(data: typing.Optional[typing.Union[dict, list]] = None, *, status: i
         if not isinstance(data, list) and not isinstance(data, dict):
             data['response'] = data
         resp.data = ujson.dumps(data)
-        resp.headers = {'Content-Type': 'application/json'}
+        resp.headers['Content-Type'] = 'application/json'
+    if etag:
+        caching.set_headers(resp, etag)
 
     return resp
 
@@ -85,15 +158,31 @@ def user_exception(e):
     return respond({'error': {'code': 400, 'name': 'Bad Request', 'info': str(e)}}, status=400)
 
 
+@bp.errorhandler(ConflictError)
+def conflict(e):
+    return respond({'error': {'code': 409, 'name': 'Conflict', 'info': str(e)}}, status=409)
+
+
+@bp.errorhandler(Overloaded)
+def overloaded(e):
+    resp = respond({'error': {'code': 503, 'name': 'Service Unavailable', 'info': str(e)}}, status=503)
+    resp.headers['Retry-After'] = '5'
+    return resp
+
+
 @bp.route('/login', methods=['POST'])
+@limiter.limit(ratelimit.configured('login'))
+@limiter.limit(ratelimit.configured('login_user'), key_func=ratelimit.login_username)
 def login():
     data = verify_fields(request.json, {'username': str, 'password': str}, 'recaptcha_response')
+    captcha = None
     if recaptcha.is_enabled():
         data = verify_fields(data, {'recaptcha_response': str}, 'username', 'password')
-        if not recaptcha.validate(data['recaptcha_response']):
-            raise UserException('reCAPTCHA was invalid.')
+        captcha = recaptcha.validate_async(data['recaptcha_response'])
 
     user = current_app.db.get_user(username=data['username'])
+    if captcha and not captcha.result():
+        raise UserException('reCAPTCHA was invalid.')
     if user is None:
         raise UserException('Username or password invalid.')
     if not user.check_pw(data['password']):
@@ -110,25 +199,164 @@ def me():
 @bp.route('/entries', methods=['GET'])
 @auth_required
 def entries():
-    return respond([
-        {'id': x.id, 'author_id': x.id, 'title': x.title, 'tags': x.tags, 'timestamp': x.timestamp.isoformat()}
-        for x in request.user.entries()
-    ])
+    etag = caching.listing_etag(request.user)
+    if caching.is_fresh(etag):
+        return caching.not_modified(etag)
+
+    page = request.user.entry_summaries(request.args.get('tag'), before=request.args.get('before', type=int),
+                                        after=request.args.get('after', type=int),
+                                        limit=request.args.get('limit', type=int))
+    return respond({
+        'entries': [x.to_json() for x in page],
+        'prev_cursor': page.prev_cursor,
+        'next_cursor': page.next_cursor,
+    }, etag=etag)
+
+
+@bp.route('/sync', methods=['GET'])
+@auth_required
+def sync():
+    changes = request.user.changes(request.args.get('since', 0, type=int), request.args.get('limit', type=int))
+    changes['entries'] = [x.to_json() for x in changes['entries']]
+    return respond(changes)
+
+
+@bp.route('/tags', methods=['GET'])
+@auth_required
+def tags():
+    etag = caching.listing_etag(request.user)
+    if caching.is_fresh(etag):
+        return caching.not_modified(etag)
+    return respond({'tags': [dict(x, last_used=x['last_used'].isoformat()) for x in request.user.tags()]}, etag=etag)
+
+
+@bp.route('/entries/search', methods=['GET'])
+@auth_required
+def entries_search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise UserException('Search query "q" missing.')
+    etag = caching.listing_etag(request.user)
+    if caching.is_fresh(etag):
+        return caching.not_modified(etag)
+
+    page = request.user.search(query, page=request.args.get('page', type=int),
+                               limit=request.args.get('limit', type=int))
+    return respond({
+        'entries': [x.to_json() for x in page],
+        'prev_page': page.prev_cursor,
+        'next_page': page.next_cursor,
+    }, etag=etag)
+
+
+@bp.route('/entries', methods=['POST'])
+@auth_required
+@limiter.limit(ratelimit.configured('new_entry'))
+@limiter.limit(ratelimit.configured('new_entry_user'), key_func=ratelimit.current_user)
+def entries_create():
+    entry = current_app.db.create_entry(request.user, **verify_entry_fields(request.json, {}, {}))
+    return respond(entry.to_json(), status=201)
+
+
+@bp.route('/entries/bulk', methods=['POST'])
+@auth_required
+@limiter.limit(ratelimit.configured('bulk_write'), key_func=ratelimit.current_user)
+def entries_bulk():
+    operations = verify_fields(request.json, {'operations': list})['operations']
+    if len(operations) > MAX_BULK_OPERATIONS:
+        raise UserException('At most {} operations are allowed per request.'.format(MAX_BULK_OPERATIONS))
+
+    # malformed operations fail on their own, the rest of the batch still goes through
+    results, valid = {}, {}
+    for index, data in enumerate(operations):
+        try:
+            valid[index] = verify_operation(data)
+        except UserException as e:
+            results[index] = {'status': 400, 'error': str(e)}
+    results.update(current_app.db.bulk_entries(request.user, valid))
+
+    return respond({'results': [
+        dict(results[index], index=index, op=valid.get(index, {}).get('op')) for index in range(len(operations))
+    ]})
+
+
+@bp.route('/export', methods=['GET'])
+@auth_required
+@limiter.limit(ratelimit.configured('export'), key_func=ratelimit.current_user)
+def export():
+    return backup.export_response(request.user, compress=request.args.get('format') == 'gzip')
+
+
+@bp.route('/import', methods=['POST'])
+@auth_required
+@limiter.limit(ratelimit.configured('bulk_write'), key_func=ratelimit.current_user)
+def import_():
+    compressed = request.content_encoding == 'gzip' or request.mimetype in ('application/gzip', 'application/x-gzip')
+    errors, invalid = [], 0
+
+    def entries():  # parsed lazily, the import pulls them in batches
+        nonlocal invalid
+        for number, line in backup.import_lines(request.stream, compressed):
+            try:
+                yield verify_backup_line(line)
+            except UserException as e:
+                invalid += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({'line': number, 'error': str(e)})
+
+    try:
+        counts = current_app.db.import_entries(request.user, entries())
+    except (OSError, EOFError):  # broken gzip data, whatever came before it is imported already
+        raise UserException('Backup could not be decompressed.')
+    return respond(dict(counts, invalid=invalid, errors=errors))
+
+
+def _editable_entry(id):
+    entry = current_app.db.get_entry(parse_id(id))
+    if not entry or not entry.can_access(request.user):
+        return abort(404)
+    if not entry.can_edit(request.user):
+        return abort(403)
+    return entry
 
 
 # noinspection PyShadowingBuiltins
 @bp.route('/entries/<id>', methods=['GET'])
 @auth_required
 def entry(id):
-    try:
-        id = int(id)
-        if id < 0:
-            raise ValueError()
-    except ValueError:
-        raise UserException('ID given is not an integer.')
+    id = parse_id(id)
+    # revalidations are answered from the version alone, the entry itself is only loaded for a new copy
+    version = current_app.db.entry_version(id)
+    if not version or version[0] != request.user.id:  # Entry.can_access
+        return abort(404)
+    tag = caching.entry_tag(id, version[1])
+    if caching.is_fresh(tag):
+        return caching.not_modified(tag)
 
     entry = current_app.db.get_entry(id)
-    if not entry or not entry.can_access(request.user):
+    if not entry or not entry.can_access(request.user):  # gone or moved in between
         return abort(404)
+    return respond(entry.to_json(), etag=caching.entry_etag(entry))
 
+
+# noinspection PyShadowingBuiltins
+@bp.route('/entries/<id>', methods=['PATCH'])
+@auth_required
+def entry_update(id):
+    data = verify_entry_fields(request.json, {}, {'revision': int})
+    entry = _editable_entry(id)
+    if 'revision' in data:
+        entry.revision = data['revision']
+    for field in ENTRY_FIELDS:
+        if field in data:
+            setattr(entry, field, data[field])
+    entry.commit()
     return respond(entry.to_json())
+
+
+# noinspection PyShadowingBuiltins
+@bp.route('/entries/<id>', methods=['DELETE'])
+@auth_required
+def entry_delete(id):
+    _editable_entry(id).delete()
+    return respond()
@@ -0,0 +1,255 @@
+"""The API as a native ASGI app, for holding thousands of mostly idle client connections per process.
+
+The read paths sync clients hammer (listing, sync, tags, single entries, the current user) run on the event
+loop with Motor. Everything else, writes, logins, search, import/export and the web UI, goes to the regular
+Flask app on a thread pool, so it all stays one app with the same routes and JSON.
+Without Motor installed, or on the SQLite backend, every request takes that second path.
+"""
+import asyncio
+import datetime
+import logging
+import re
+import time
+import typing
+import urllib.parse
+
+import pytz
+import ujson
+from bson.codec_options import CodecOptions
+from flask import Flask
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import HTTPException, InternalServerError, NotFound, Unauthorized
+from werkzeug.http import parse_etags, quote_etag
+
+from journal.db import Entry, EntrySummary, User
+from journal.db.dataclasses.page import clamp_limit, keyset, keyset_page
+from journal.db.dataclasses.user import SYNC_RESET, TAG_PROJECTION, TAG_SORT, changes_query, merge_changes, \
+    sync_expired
+from journal.db.storage.mongo import MongoBackend
+from journal.helpers import caching, metrics
+from journal.helpers.asgi import WSGIBridge
+from journal.modules.api import UserException, parse_id
+
+try:
+    import motor.motor_asyncio
+except ImportError:  # optional, the Flask app answers everything then
+    motor = None
+
+log = logging.getLogger(__name__)
+
+
+def _path(scope: dict) -> str:
+    """The path within the app, like Flask's request.path."""
+    root = scope.get('root_path', '')
+    return scope['path'][len(root):] if root and scope['path'].startswith(root) else scope['path']
+
+
+class NotModified(Exception):
+    def __init__(self, tag: str):
+        super().__init__(tag)
+        self.tag = tag
+
+
+class Request:
+    """The little of a request the handlers below need, shaped like Flask's."""
+
+    def __init__(self, scope: dict):
+        self.method = scope['method']
+        self.path = _path(scope)
+        self.query_string = scope.get('query_string', b'')
+        self.args = MultiDict(urllib.parse.parse_qsl(self.query_string.decode('latin-1'), keep_blank_values=True))
+        self.headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope.get('headers', [])])
+        self.if_none_match = parse_etags(self.headers.get('If-None-Match'))
+
+
+class AsyncAPI:
+    """ASGI entry point, see asgi.py next to wsgi.py."""
+
+    def __init__(self, app: Flask, threads: int = 32):
+        self.app = app
+        self.db = app.db
+        self.bridge = WSGIBridge(app, threads)
+        self.native = motor is not None and isinstance(self.db.backend, MongoBackend)
+        if not self.native:
+            log.info('Motor missing or not on MongoDB, all requests go through the WSGI app.')
+        self._client = None
+        self._collections = {}
+        # method, pattern, route as Flask knows it (for metrics), handler
+        self.routes = [
+            ('GET', re.compile(r'/api/users/@me'), '/api/users/@me', self.me),
+            ('GET', re.compile(r'/api/entries'), '/api/entries', self.entries),
+            ('GET', re.compile(r'/api/sync'), '/api/sync', self.sync),
+            ('GET', re.compile(r'/api/tags'), '/api/tags', self.tags),
+            # anything that isn't a plain ID (search, malformed ones) is left to Flask
+            ('GET', re.compile(r'/api/entries/(?P<id>[0-9]+)'), '/api/entries/<id>', self.entry),
+        ]
+
+    async def __call__(self, scope: dict, receive: typing.Callable, send: typing.Callable):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return  # no websockets here
+
+        if self.native:
+            for method, pattern, rule, handler in self.routes:
+                match = pattern.fullmatch(_path(scope))
+                if match and scope['method'] == method:
+                    return await self._handle(scope, send, rule, handler, match.groupdict())
+        await self.bridge(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+        self._client, self._collections = None, {}
+        self.bridge.close()
+
+    def _collection(self, name: str):
+        # created on first use, Motor ties itself to the event loop that's running then
+        if self._client is None:
+            backend = self.db.backend
+            self._client = motor.motor_asyncio.AsyncIOMotorClient(backend.uri, **backend.options)
+            # noinspection PyArgumentList
+            db = self._client.get_database(backend.db_name, codec_options=CodecOptions(tz_aware=True, tzinfo=pytz.UTC))
+            self._collections = {x: db.get_collection(x) for x in ['users', 'entries', 'tags', 'tombstones']}
+        return self._collections[name]
+
+    async def _handle(self, scope, send, rule, handler, params):
+        start = time.perf_counter()
+        request = Request(scope)
+        tag = None
+        try:
+            data, tag = await handler(request, **params)
+            status = 200 if data else 204
+        except NotModified as e:
+            data, tag, status = None, e.tag, 304
+        except HTTPException as e:
+            data, status = {'error': {'code': e.code, 'name': e.name}}, e.code
+        except UserException as e:
+            data, status = {'error': {'code': 400, 'name': 'Bad Request', 'info': str(e)}}, 400
+        except Exception:
+            log.exception('Exception on %s [%s]', request.path, request.method)
+            e = InternalServerError()
+            data, status = {'error': {'code': e.code, 'name': e.name}}, e.code
+
+        # what respond() does in the Flask app
+        headers = []
+        body = b''
+        if data:
+            body = ujson.dumps(data).encode()
+            headers.append((b'content-type', b'application/json'))
+        headers.append((b'content-length', str(len(body)).encode()))
+        if tag:
+            headers += [(b'etag', quote_etag(tag).encode()), (b'cache-control', b'private, no-cache')]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+        if metrics.registry.enabled:
+            metrics.registry.observe('request', (('route', rule), ('method', request.method), ('status', str(status))),
+                                     time.perf_counter() - start)
+
+    async def _user(self, request: Request) -> User:
+        """DatabaseInterface.get_user(token=...) sharing its cache, raises 401 like auth_required."""
+        auth = request.headers.get('Authorization')
+        claims = self.db.token_claims(auth) if auth else None
+        if claims is None:
+            raise Unauthorized()
+        cached = self.db.user_cache.get(claims['uid'])
+        if cached is None or cached['token_revision'] != claims['rev']:
+            raw = await self._collection('users').find_one({'_id': claims['uid']})
+            if raw is None:  # might happen, user could've deleted their account
+                raise Unauthorized()
+            cached = User(self.db, **raw).serialize()
+            self.db.user_cache.put(claims['uid'], cached)
+            if cached['token_revision'] != claims['rev']:  # invalidate old tokens
+                raise Unauthorized()
+        return User(self.db, **cached)
+
+    async def _listing_tag(self, request: Request, user: User) -> str:
+        """caching.listing_etag(), both lookups at once."""
+        query = {'author_id': user.id}
+        newest = await asyncio.gather(*[
+            self._collection(name).find_one(query, {'updated': True}, sort=[('updated', -1)])
+            for name in ['entries', 'tombstones']
+        ])
+        version = max((raw['updated'] for raw in newest if raw), default=0)
+        tag = caching.listing_tag(user.id, version, request.path, request.query_string)
+        if tag in request.if_none_match:
+            raise NotModified(tag)
+        return tag
+
+    # the routes, same answers as their namesakes in journal.modules.api
+
+    async def me(self, request: Request):
+        user = await self._user(request)
+        return user.to_json(), None
+
+    async def entries(self, request: Request):
+        user = await self._user(request)
+        tag = await self._listing_tag(request, user)
+
+        before, after = request.args.get('before', type=int), request.args.get('after', type=int)
+        limit = clamp_limit(request.args.get('limit', type=int))
+        query = {'author_id': user.id}
+        if request.args.get('tag'):
+            query['tags'] = request.args['tag'].lower()
+        direction = keyset(query, before, after)
+        cursor = self._collection('entries').find(query, EntrySummary.PROJECTION).sort('_id', direction) \
+            .limit(limit + 1)
+        page = keyset_page([EntrySummary(**raw) for raw in await cursor.to_list(limit + 1)], limit, before, after)
+        return {
+            'entries': [x.to_json() for x in page],
+            'prev_cursor': page.prev_cursor,
+            'next_cursor': page.next_cursor,
+        }, tag
+
+    async def sync(self, request: Request):
+        user = await self._user(request)
+        since = request.args.get('since', 0, type=int)
+        now = datetime.datetime.now(tz=pytz.UTC)
+        if sync_expired(since, now):
+            return dict(SYNC_RESET), None
+
+        limit = clamp_limit(request.args.get('limit', type=int))
+        query = changes_query(user.id, since)
+        written, deleted = await asyncio.gather(
+            self._collection('entries').find(query).sort('updated', 1).limit(limit + 1).to_list(None),
+            self._collection('tombstones').find(query, {'updated': True}).sort('updated', 1).limit(limit + 1)
+            .to_list(None),
+        )
+        changes = merge_changes(self.db, written, deleted, since, limit, now)
+        changes['entries'] = [x.to_json() for x in changes['entries']]
+        return changes, None
+
+    async def tags(self, request: Request):
+        user = await self._user(request)
+        tag = await self._listing_tag(request, user)
+        cursor = self._collection('tags').find({'author_id': user.id}, TAG_PROJECTION).sort(TAG_SORT)
+        return {'tags': [dict(x, last_used=x['last_used'].isoformat()) for x in await cursor.to_list(None)]}, tag
+
+    # noinspection PyShadowingBuiltins
+    async def entry(self, request: Request, id: str):
+        user = await self._user(request)
+        id = parse_id(id)
+        # DatabaseInterface.entry_version() first, so revalidations don't load the content
+        raw = await self._collection('entries').find_one({'_id': id}, {'author_id': True, 'updated': True})
+        if not raw or raw['author_id'] != user.id:
+            raise NotFound()
+        tag = caching.entry_tag(id, raw.get('updated') or id)
+        if tag in request.if_none_match:
+            raise NotModified(tag)
+
+        raw = await self._collection('entries').find_one({'_id': id})
+        entry = Entry(self.db, **raw) if raw else None
+        if not entry or not entry.can_access(user):
+            raise NotFound()
+        return entry.to_json(), caching.entry_etag(entry)
@@ -1,12 +1,15 @@
 import datetime
 import functools
 import jwt.exceptions
-import mistune
 import pytz
-from flask import Blueprint, render_template, request, Request, redirect, abort, Response, current_app
+import mimetypes
+from flask import Blueprint, render_template, request, Request, redirect, abort, Response, current_app, \
+    send_from_directory
 
-from journal.db import User
-from journal.helpers import recaptcha
+from journal.db import ConflictError, User
+from journal.db.hashing import Overloaded
+from journal.helpers import assets, backup, caching, metrics, recaptcha, ratelimit
+from journal.helpers.ratelimit import limiter
 
 bp = Blueprint('web', __name__, url_prefix='', static_folder='static', static_url_path='/static',
                template_folder='templates')
@@ -21,7 +24,6 @@ class ValidationError(Exception):
 
 
 request: ExtendedRequest = request
-markdown = mistune.Markdown()
 
 
 def active(request: Request, page):
@@ -35,6 +37,7 @@ def base_data(request: ExtendedRequest, **additional):
     data = {
         'request': request, 'active': lambda page: active(request, page), 'b': __builtins__,
         'csrf': lambda **kwargs: generate_csrf(request, **kwargs), 'app': current_app, 'recaptcha': recaptcha,
+        'asset_url': assets.url,
     }
     data.update(additional)
 
@@ -74,6 +77,9 @@ def root():
 
 @bp.before_request
 def setup():
+    if request.endpoint in ('web.static', 'web.static_dist'):  # no need to look anyone up for a stylesheet
+        request.user = None
+        return
     token = request.cookies.get('token')
     request.user = current_app.db.get_user(token=token)
 
@@ -94,12 +100,25 @@ def login_required(f):
     return decorated
 
 
+@bp.route('/static/dist/<path:filename>')
+def static_dist(filename):
+    name, encoding = assets.variant(filename, request.accept_encodings)
+    resp = send_from_directory(assets.DIST_DIR, name, mimetype=mimetypes.guess_type(filename)[0])
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Cache-Control'] = assets.IMMUTABLE
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
 @bp.route('/terms')
 def terms():
     return render_template('terms.jinja2', **base_data(request))
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit(ratelimit.configured('login'), methods=['POST'])
+@limiter.limit(ratelimit.configured('login_user'), key_func=ratelimit.login_username, methods=['POST'])
 def login():
     if request.method == 'POST':
         resp = redirect('/app', 302)
@@ -109,11 +128,12 @@ def login():
         if not (username and password):
             return render_template('login.jinja2', **base_data(request), warn='Required fields left empty.')
 
-        if recaptcha.is_enabled():
-            if not recaptcha.validate(request.form.get('g-recaptcha-response')):
-                return render_template('login.jinja2', **base_data(request), warn='reCAPTCHA failed.')
-
+        # the captcha round-trip to Google overlaps with our own user lookup
+        captcha = recaptcha.validate_async(request.form.get('g-recaptcha-response'))
         user = current_app.db.get_user(username=username)
+        if not captcha.result():
+            return render_template('login.jinja2', **base_data(request), warn='reCAPTCHA failed.')
+
         if user:
             if user.check_pw(password):
                 resp.set_cookie('token', user.create_token(),
@@ -154,11 +174,25 @@ def app():
 @bp.route('/app/entries')
 @login_required
 def entries():
+    etag = caching.page_etag(request.user, caching.listing_etag(request.user))
+    if caching.is_fresh(etag):
+        return caching.not_modified(etag)
+
+    query = request.args.get('q', '').strip()
+    if query:
+        page = request.user.search(query, page=request.args.get('page', type=int),
+                                   limit=request.args.get('limit', type=int))
+        return caching.cached(render_template('app/entries.jinja2', **base_data(request), entries=page,
+                                              query=query), etag)
+
     tag = request.args.get('tag')
     if tag:
         tag = tag.strip().lower()
-    return render_template('app/entries.jinja2', **base_data(request),
-                           entries=request.user.entries(tag), filter=tag)
+    page = request.user.entry_summaries(tag, before=request.args.get('before', type=int),
+                                        after=request.args.get('after', type=int),
+                                        limit=request.args.get('limit', type=int))
+    return caching.cached(render_template('app/entries.jinja2', **base_data(request),
+                                          entries=page, filter=tag, tags=request.user.tags()), etag)
 
 
 @bp.route('/app/settings', methods=['GET', 'POST'])
@@ -171,43 +205,46 @@ def settings():
         warn = ''
         new_token_required = False
 
-        # security settings
-        uname = request.form.get('username')
-        if uname:
-            try:
-                request.user.username = uname
-            except AssertionError as e:
-                warn += str(e) + '\n'
-        if request.form.get('password'):
-            request.user.password = request.form.get('password')
-            new_token_required = True
-        if request.form.get('session-invalidation'):
-            request.user.invalidate_tokens()
-            new_token_required = True
-            warn += 'All other sessions have been logged out.\n'
-
-        # personalization
-        request.user.display_name = request.form.get('display-name')
-        request.user.ui_theme = request.form.get('theme')
-        request.user.timezone = request.form.get('timezone')
-        request.user.ui_font_title = request.form.get('title-font')
-        request.user.ui_font_body = request.form.get('body-font')
-        expiry = request.form.get('session-length')
-        if expiry:
-            try:
-                expiry = int(expiry)
-                if expiry < 0:
-                    raise ValueError('Cannot have a negative expiry time.')
-                if 0 < expiry < 3600:  # cleverly dodging 0
-                    raise ValueError('A session expiry time under 1 hour is potentially dangerous '
-                                     'and could lock you out of your account forever.')
-                request.user.token_expiry = expiry
-                new_token_required = True
-            except ValueError as e:
-                warn += f'{e}\n'
-            except OverflowError:
-                warn += f'Please pick a smaller session expiry time.'
-        request.user.commit()
+        try:
+            with request.user.batch():  # one write for the whole form
+                # security settings
+                uname = request.form.get('username')
+                if uname:
+                    try:
+                        request.user.username = uname
+                    except AssertionError as e:
+                        warn += str(e) + '\n'
+                if request.form.get('password'):
+                    request.user.password = request.form.get('password')
+                    new_token_required = True
+                if request.form.get('session-invalidation'):
+                    request.user.invalidate_tokens()
+                    new_token_required = True
+                    warn += 'All other sessions have been logged out.\n'
+
+                # personalization
+                request.user.display_name = request.form.get('display-name')
+                request.user.ui_theme = request.form.get('theme')
+                request.user.timezone = request.form.get('timezone')
+                request.user.ui_font_title = request.form.get('title-font')
+                request.user.ui_font_body = request.form.get('body-font')
+                expiry = request.form.get('session-length')
+                if expiry:
+                    try:
+                        expiry = int(expiry)
+                        if expiry < 0:
+                            raise ValueError('Cannot have a negative expiry time.')
+                        if 0 < expiry < 3600:  # cleverly dodging 0
+                            raise ValueError('A session expiry time under 1 hour is potentially dangerous '
+                                             'and could lock you out of your account forever.')
+                        request.user.token_expiry = expiry
+                        new_token_required = True
+                    except ValueError as e:
+                        warn += f'{e}\n'
+                    except OverflowError:
+                        warn += f'Please pick a smaller session expiry time.'
+        except AssertionError as e:  # taken usernames only show up once we write
+            warn += str(e) + '\n'
 
         r = render_template('app/settings.jinja2', **base_data(request), notice='Settings saved.', warn=warn.strip(),
                             **additional)
@@ -219,6 +256,13 @@ def settings():
     return render_template('app/settings.jinja2', **base_data(request), **additional)
 
 
+@bp.route('/app/settings/export')
+@login_required
+@limiter.limit(ratelimit.configured('export'), key_func=ratelimit.current_user)
+def export():
+    return backup.export_response(request.user, compress=request.args.get('format') == 'gzip')
+
+
 @bp.route('/app/settings/delete-account', methods=['GET', 'POST'])
 @login_required
 def account_delete():
@@ -230,6 +274,8 @@ def account_delete():
 
 @bp.route('/app/entries/new')
 @login_required
+@limiter.limit(ratelimit.configured('new_entry'))
+@limiter.limit(ratelimit.configured('new_entry_user'), key_func=ratelimit.current_user)
 def entries_new():
     e = current_app.db.create_entry(request.user)
     return redirect('/app/entry/{}/edit'.format(e.id), 302)
@@ -250,6 +296,16 @@ def validation_error(e):
     return render_template('errors/403.jinja2', info=str(e), **base_data(request))
 
 
+@bp.errorhandler(429)
+def too_many_requests(e):
+    return render_template('errors/429.jinja2', info=e.description, **base_data(request)), 429
+
+
+@bp.errorhandler(Overloaded)
+def overloaded(e):
+    return render_template('errors/503.jinja2', info=str(e), **base_data(request)), 503, {'Retry-After': '5'}
+
+
 @bp.route('/app/entry/<_id>/view')
 @login_required
 def entry_view(_id):
@@ -260,8 +316,11 @@ def entry_view(_id):
     if entry is None or not entry.can_access(request.user):
         return abort(404)
 
-    return render_template('app/entry/view.jinja2', **base_data(request),
-                           entry_html=markdown(entry.content), entry=entry)
+    etag = caching.page_etag(request.user, caching.entry_etag(entry))
+    if caching.is_fresh(etag):
+        return caching.not_modified(etag)
+    return caching.cached(render_template('app/entry/view.jinja2', **base_data(request),
+                                          entry_html=entry.html, entry=entry), etag)
 
 
 @bp.route('/app/entry/<_id>/edit', methods=['GET', 'POST'])
@@ -275,10 +334,24 @@ def entry_edit(_id):
         return abort(404)
 
     if request.method == 'POST':
+        revision = request.form.get('revision', type=int)
+        if revision is not None:
+            entry.revision = revision  # what the form was based on, not what we just loaded
         entry.title = request.form.get('title', '')
         entry.content = request.form.get('body', '')
         entry.tags_human = request.form.get('tags', '')
-        entry.commit()
+        try:
+            entry.commit()
+        except ConflictError as e:
+            latest = current_app.db.get_entry(entry.id)
+            if latest is None:
+                return abort(404)
+            # keep what they typed, but on top of the latest revision so saving again is a conscious overwrite
+            latest.title = request.form.get('title', '')
+            latest.content = request.form.get('body', '')
+            latest.tags_human = request.form.get('tags', '')
+            return render_template('app/entry/edit.jinja2', **base_data(request), entry=latest,
+                                   warn='{} Saving again will overwrite those changes.'.format(e)), 409
         return redirect('/app/entry/{}/view'.format(_id), 302)
 
     return render_template('app/entry/edit.jinja2', **base_data(request), entry=entry)
@@ -306,4 +379,5 @@ def entry_delete(_id):
 def admin():
     if 'admin' not in request.user.flags:
         return abort(403)
-    return render_template('app/admin.jinja2', **base_data(request))
+    return render_template('app/admin.jinja2', **base_data(request),
+                           metrics=metrics.registry.snapshot() if metrics.registry.enabled else None)
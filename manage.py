@@ -0,0 +1,75 @@
+import argparse
+
+import journal
+from journal.db import migrations
+from journal.helpers import assets
+
+
+def migrate(app, args):
+    before = migrations.schema_version(app.db)
+    after = app.db.ensure_indexes()
+    print('Schema version {} -> {}'.format(before, after))
+
+
+def explain(app, args):
+    user = app.db.get_user(username=args.username)
+    if user is None:
+        raise SystemExit('No such user.')
+    if args.check:
+        tag = args.tag or next((x['tag'] for x in user.tags()), 'untagged')
+        problems = migrations.check_listing_indexes(app.db, user.id, tag)
+        if problems:
+            raise SystemExit('\n'.join(problems))
+        print('OK')
+        return
+    print(migrations.listing_index(app.db, user.id, args.tag) or 'COLLSCAN')
+
+
+def rebuild_tags(app, args):
+    if args.username:
+        user = app.db.get_user(username=args.username)
+        if user is None:
+            raise SystemExit('No such user.')
+        app.db.rebuild_tags(user.id)
+    else:
+        app.db.rebuild_tags()
+    print('Tag index rebuilt.')
+
+
+def build_assets(app, args):
+    manifest = assets.build()
+    print('Built {} assets into {}{}'.format(len(manifest), assets.DIST_DIR,
+                                             '' if assets.brotli else ' (install brotli for .br files)'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance tasks for the journal.')
+    parser.add_argument('--config', default='config.yml')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    commands.add_parser('migrate', help='create/update indexes and run pending migrations').set_defaults(run=migrate)
+
+    p = commands.add_parser('explain', help='show which index serves a user\'s entry listing')
+    p.add_argument('username')
+    p.add_argument('--tag')
+    p.add_argument('--check', action='store_true',
+                   help='fail unless both the plain and the tag listing use their indexes')
+    p.set_defaults(run=explain)
+
+    p = commands.add_parser('rebuild-tags', help='recount the per-user tag index from the entries')
+    p.add_argument('username', nargs='?', help='only this user (default: everyone)')
+    p.set_defaults(run=rebuild_tags)
+
+    p = commands.add_parser('build-assets', help='fingerprint and precompress the static files')
+    p.set_defaults(run=build_assets, needs_app=False)
+
+    args = parser.parse_args()
+    app = None
+    if getattr(args, 'needs_app', True):
+        app = journal.create_app_from_config_file(args.config, auto_migrate=False)
+    args.run(app, args)
+
+
+if __name__ == '__main__':
+    main()
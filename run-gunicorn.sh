@@ -1,2 +1,15 @@
 #!/bin/sh
-gunicorn $@ wsgi
+# Worker presets, pick one with JOURNAL_PRESET or override WORKERS/THREADS directly.
+# Each worker opens its own MongoDB pool, so keep workers * mongodb_options.maxPoolSize
+# below what mongod will accept (threads is a good maxPoolSize).
+cores=$(nproc 2>/dev/null || echo 1)
+case "${JOURNAL_PRESET:-default}" in
+    small) workers=1; threads=4 ;;
+    large) workers=$((cores * 2 + 1)); threads=8 ;;
+    *) workers=$((cores + 1)); threads=4 ;;
+esac
+if [ -n "$JOURNAL_ASGI" ]; then
+    # one event loop per worker, the Flask side's thread pool is asgi_threads in config.yml
+    exec gunicorn --workers "${WORKERS:-$workers}" -k uvicorn.workers.UvicornWorker "$@" asgi
+fi
+exec gunicorn --workers "${WORKERS:-$workers}" --threads "${THREADS:-$threads}" "$@" wsgi